@@ -0,0 +1,413 @@
+# Copyright 2013-2019 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+"""Benchmarks for contrib, run on synthetic git repositories.
+
+Run ``python -m contrib.bench`` to generate a repository, time the main
+stages of ``contrib`` with cold and warm ``line-data`` caches, and print
+the results.  Use ``-o FILE`` to save them as a JSON baseline, and
+``--compare FILE`` to compare against a baseline from another revision.
+"""
+
+from __future__ import division
+
+import argparse
+import contextlib
+import json
+import multiprocessing.pool
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import contrib.main as main
+
+#: fraction slower than the baseline that counts as a regression
+default_threshold = 0.1
+
+#: differences smaller than this many seconds are never regressions
+noise = 0.005
+
+
+def generate_repo(path, authors=5, files=100, commits=50, lines=50, seed=0):
+    """Create a git repository with random history at ``path``.
+
+    ``files`` files of about ``lines`` lines each are added in the first
+    commit, and each later commit by a random one of ``authors`` authors
+    rewrites, inserts, or deletes lines in a few files, or adds a file.
+    Commits are a day apart.  The same arguments always make the same
+    history.  Uses ``git fast-import``, so large repositories are quick
+    to make.
+    """
+    rng = random.Random(seed)
+    names = ["Author %d" % i for i in range(authors)]
+    paths = ["src/dir%d/file%d.py" % (i % 10, i) for i in range(files)]
+    contents = {}
+
+    def random_line():
+        if rng.random() < 0.1:
+            return "# comment %d" % rng.randrange(1000)
+        return "x%d = %d" % (rng.randrange(1000), rng.randrange(1000))
+
+    def data(text):
+        encoded = text.encode("utf-8")
+        return b"data %d\n%s\n" % (len(encoded), encoded)
+
+    stream = []
+    start = 1420070400  # 2015-01-01
+    for n in range(commits):
+        if n == 0:
+            changed = paths
+        elif rng.random() < 0.1:
+            changed = ["src/new/file%d.py" % n]
+        else:
+            changed = rng.sample(sorted(contents), min(len(contents), 3))
+
+        for changed_path in changed:
+            body = contents.setdefault(changed_path, [])
+            if not body:
+                body.extend(random_line() for _ in range(lines))
+                continue
+            pos = rng.randrange(len(body))
+            length = rng.randrange(1, 10)
+            body[pos : pos + rng.choice([0, length])] = [
+                random_line() for _ in range(length)
+            ]
+
+        author = names[0] if n == 0 else rng.choice(names)
+        email = "%s@example.com" % author.lower().replace(" ", ".")
+        stamp = "%s <%s> %d +0000" % (author, email, start + n * 86400)
+        stream.append(b"commit refs/heads/master\n")
+        stream.append(("author %s\ncommitter %s\n" % (stamp, stamp)).encode("utf-8"))
+        stream.append(data("commit %d" % n))
+        for changed_path in changed:
+            stream.append(b"M 100644 inline %s\n" % changed_path.encode("utf-8"))
+            stream.append(data("\n".join(contents[changed_path]) + "\n"))
+        stream.append(b"\n")
+
+    os.makedirs(path)
+    subprocess.check_call(["git", "init", "-q"], cwd=path)
+    subprocess.check_call(
+        ["git", "symbolic-ref", "HEAD", "refs/heads/master"], cwd=path
+    )
+    subprocess.run(
+        ["git", "fast-import", "--quiet"], cwd=path, input=b"".join(stream), check=True
+    )
+    subprocess.check_call(["git", "reset", "-q", "--hard"], cwd=path)
+
+
+@contextlib.contextmanager
+def cache(directory):
+    """Point contrib's caches at a ``line-data`` directory in ``directory``.
+
+    Shared readers are dropped on entry, so nothing is carried over in
+    memory from an earlier cache.
+    """
+    names = ("cache_dir", "parts_dir", "blame_store_path", "costs_file")
+    names += ("history_file",)
+    saved = dict((name, getattr(main, name)) for name in names)
+
+    line_data = os.path.join(directory, "line-data")
+    main.cache_dir = line_data
+    main.parts_dir = os.path.join(line_data, "parts")
+    main.blame_store_path = os.path.join(line_data, "blame.sqlite")
+    main.costs_file = os.path.join(line_data, "costs.json")
+    main.history_file = os.path.join(line_data, "history.json")
+    forget()
+    try:
+        yield
+    finally:
+        forget()
+        for name, value in saved.items():
+            setattr(main, name, value)
+
+
+def forget():
+    """Drop contrib's in-memory caches, as if a new run had started."""
+    if main._git_objects is not None:
+        main._git_objects.close()
+    main._git_objects = None
+    main._cache_manifest = None
+    main._blame_store = None
+    main._history = None
+
+
+class Benchmark(object):
+    """Times stages of contrib against one synthetic repository."""
+
+    def __init__(self, repo, workdir, samples=10, repeat=3, jobs=None):
+        self.repo = repo
+        self.workdir = workdir
+        self.samples = samples
+        self.repeat = repeat
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.results = {}
+        self.parts = {"src": [r"^src/"]}
+        self.places = [re.compile(r"^src/")]
+
+    def time(self, name, state, func):
+        """Time ``func()``, keeping the fastest of ``repeat`` runs for warm
+        caches.  Returns what ``func()`` returned."""
+        runs = 1 if state == "cold" else self.repeat
+        best = None
+        for _ in range(runs):
+            with open(os.devnull, "w") as devnull:
+                with contextlib.redirect_stdout(devnull):
+                    start = time.perf_counter()
+                    result = func()
+                    elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        self.results.setdefault(name, {})[state] = best
+        return result
+
+    def run(self):
+        """Run every benchmark with a cold cache, then with a warm one."""
+        saved = main.git_repo_dir, main.executor, main.blame_jobs
+        main.git_repo_dir = self.repo
+        main.executor = "thread"
+        main.blame_jobs = self.jobs
+
+        directory = tempfile.mkdtemp(dir=self.workdir)
+        try:
+            for state in ("cold", "warm"):
+                with cache(directory):
+                    self._run(state)
+                    self._run_startup(state, directory)
+        finally:
+            main.git_repo_dir, main.executor, main.blame_jobs = saved
+        return self.results
+
+    def _git_blame(self, head):
+        main.blame_pool = multiprocessing.pool.ThreadPool(self.jobs)
+        try:
+            return main.git_blame(head, self.places, "src")
+        finally:
+            main.blame_pool.terminate()
+            main.blame_pool = None
+
+    def _run(self, state):
+        head = main.git_objects().rev_parse("HEAD")
+
+        def sampled_history():
+            main._history = None  # read the history cache every time
+            return main.sampled_history(self.samples)
+
+        history = self.time("sampled_history", state, sampled_history)
+        self.time(
+            "files_for_commit",
+            state,
+            lambda: main.files_for_commit(head, self.places),
+        )
+
+        filename = main.files_for_commit(head, self.places)[0]
+        output = main.git_blame_file((head, filename, None))
+        self.time("iter_blame", state, lambda: list(main.iter_blame(output * 20)))
+
+        self.time("git_blame", state, lambda: self._git_blame(head))
+        self.time("build_index", state, lambda: main.build_index(history, self.parts))
+
+        main._cache_manifest = None  # fuzzing starts by loading the manifest
+        self.time(
+            "fuzz_history",
+            state,
+            lambda: main.fuzz_history(history, 10, self.parts),
+        )
+
+        orgmap = dict(("Author %d" % i, "Org %d" % (i % 3)) for i in range(100))
+        resolver = main.IdentityResolver([["Author 0", "Author 1"]], orgmap)
+
+        def org_stats():
+            stats = main.OrgStats(main.AuthorStats("src", self.places), resolver)
+            counts = [stats[commit] for commit, _ in history]
+            stats.save()
+            return counts
+
+        self.time("OrgStats", state, org_stats)
+
+        def count_matrix():
+            stats = main.AuthorStats("src", self.places)
+            counts = main.CountMatrix.from_counts([stats[c] for c, _ in history])
+            return counts.resolve(resolver)
+
+        counts = self.time("count_matrix", state, count_matrix)
+
+        plot_file = os.path.join(self.workdir, "plot.png")
+        dates = [date for _, date in history]
+        self.time(
+            "plot", state, lambda: main.plot(plot_file, "Benchmark", counts, dates)
+        )
+
+    def contrib(self, directory, *args):
+        """Run the ``contrib`` command from this source tree in ``directory``."""
+        root = os.path.dirname(os.path.dirname(os.path.abspath(main.__file__)))
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            p for p in (root, env.get("PYTHONPATH")) if p
+        )
+        cmd = [sys.executable, os.path.join(root, "bin", "contrib")] + list(args)
+        subprocess.run(
+            cmd, cwd=directory, env=env, stdout=subprocess.DEVNULL, check=True
+        )
+
+    def _run_startup(self, state, directory):
+        """Time whole ``contrib`` commands that should start quickly.
+
+        ``--index`` runs after the other stages have filled the cache, so
+        it only reads cached counts; its time is mostly startup.
+        """
+        with open(os.path.join(directory, "contrib.yaml"), "w") as f:
+            json.dump(
+                {"contrib": {"repo": self.repo, "commit": "HEAD", "parts": self.parts}},
+                f,
+            )
+
+        self.time("startup_help", state, lambda: self.contrib(directory, "--help"))
+        self.time(
+            "startup_index",
+            state,
+            lambda: self.contrib(
+                directory, "--index", "-s", str(self.samples), "-j", str(self.jobs)
+            ),
+        )
+
+
+def compare(results, baseline, threshold=default_threshold):
+    """Compare benchmark results against a baseline.
+
+    Both are dicts like the ``results`` in a saved JSON file.  Returns a
+    list of (name, state, baseline seconds, seconds, ratio) for every
+    timing in both, and a list of the ones slower than the baseline by
+    more than ``threshold`` (a fraction) and more than ``noise``.
+    """
+    rows = []
+    regressions = []
+    for name in sorted(results):
+        for state in ("cold", "warm"):
+            if state not in results[name] or state not in baseline.get(name, {}):
+                continue
+            old, new = baseline[name][state], results[name][state]
+            ratio = new / old if old else float("inf")
+            row = (name, state, old, new, ratio)
+            rows.append(row)
+            if ratio > 1 + threshold and new - old > noise:
+                regressions.append(row)
+    return rows, regressions
+
+
+def git_version():
+    return subprocess.check_output(["git", "--version"]).decode("utf-8").strip()
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog="python -m contrib.bench")
+    parser.add_argument(
+        "--authors", type=int, default=5, help="authors in the repository (default 5)"
+    )
+    parser.add_argument(
+        "--files", type=int, default=100, help="files in the first commit (default 100)"
+    )
+    parser.add_argument(
+        "--commits", type=int, default=50, help="commits in the history (default 50)"
+    )
+    parser.add_argument(
+        "--lines", type=int, default=50, help="lines in each new file (default 50)"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="random seed for the repository"
+    )
+    parser.add_argument(
+        "-s", "--samples", type=int, default=10, help="commits to sample (default 10)"
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=3,
+        help="runs of each warm-cache benchmark; the fastest is kept (default 3)",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None, help="concurrent blame jobs"
+    )
+    parser.add_argument(
+        "-o", "--output", default=None, help="save results as JSON to this file"
+    )
+    parser.add_argument(
+        "--compare", default=None, metavar="FILE", help="JSON baseline to compare to"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=default_threshold * 100,
+        help="percent slower than the baseline that is a regression (default 10)",
+    )
+    return parser
+
+
+def bench_main():
+    args = create_parser().parse_args()
+    params = dict(
+        (name, getattr(args, name))
+        for name in ("authors", "files", "commits", "lines", "seed", "samples")
+    )
+
+    workdir = tempfile.mkdtemp(prefix="contrib-bench-")
+    try:
+        repo = os.path.join(workdir, "repo")
+        print("==> Generating repository: %s" % json.dumps(params, sort_keys=True))
+        generate_repo(
+            repo, args.authors, args.files, args.commits, args.lines, args.seed
+        )
+        bench = Benchmark(repo, workdir, args.samples, args.repeat, args.jobs)
+        results = bench.run()
+    finally:
+        shutil.rmtree(workdir)
+
+    print("%-18s %10s %10s" % ("benchmark", "cold", "warm"))
+    for name in sorted(results):
+        print(
+            "%-18s %9.4fs %9.4fs" % (name, results[name]["cold"], results[name]["warm"])
+        )
+
+    if args.output:
+        data = {
+            "params": params,
+            "python": platform.python_version(),
+            "git": git_version(),
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("==> Saved results to '%s'." % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("params") != params:
+            print("==> Warning: baseline was run with %s" % baseline.get("params"))
+
+        rows, regressions = compare(results, baseline["results"], args.threshold / 100)
+        print()
+        print(
+            "%-18s %-5s %10s %10s %8s" % ("benchmark", "cache", "baseline", "now", "")
+        )
+        for name, state, old, new, ratio in rows:
+            print("%-18s %-5s %9.4fs %9.4fs %7.2fx" % (name, state, old, new, ratio))
+        if regressions:
+            print()
+            print(
+                "==> %d benchmarks regressed by more than %g%%."
+                % (len(regressions), args.threshold)
+            )
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    bench_main()
@@ -4,6 +4,7 @@
 # SPDX-License-Identifier: (Apache-2.0 OR MIT)
 
 import os.path
+import re
 
 import json
 import jsonschema
@@ -34,6 +35,10 @@ contrib_yaml_schema = {
                     "type": "string",
                     "description": "optional json file mapping authors to organizations",
                 },
+                "mailmap": {
+                    "type": "string",
+                    "description": "optional git .mailmap file mapping author names",
+                },
                 "parts": {
                     "type": "object",
                     "default": {},
@@ -73,6 +78,27 @@ orgmap_schema = {
 }
 
 
+def read_mailmap(path):
+    """Read author name mappings from a file in git's ``.mailmap`` format.
+
+    Blame output only has author names, so only entries that give both
+    the proper name and the commit name (``Proper Name <proper@email>
+    Commit Name <commit@email>``) are used.  Returns a dict from commit
+    names to proper names.
+    """
+    entry = re.compile(r"^([^<]*?)\s*<[^>]*>\s*([^<]*?)\s*<[^>]*>\s*$")
+
+    mailmap = {}
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            match = entry.match(line)
+            if match and all(match.groups()):
+                proper, commit = match.groups()
+                mailmap[commit] = proper
+    return mailmap
+
+
 class ContribConfig(object):
     def __init__(self, path):
         with open(path) as config_file:
@@ -97,6 +123,13 @@ class ContribConfig(object):
             self.orgmap_file = orgmap_file
             jsonschema.validate(orgmap_schema, self.orgmap)
 
+        # load mailmap if present
+        self.mailmap = {}
+        mailmap_file = data.get("mailmap")
+        if mailmap_file:
+            mailmap_file = os.path.normpath(os.path.join(config_dir, mailmap_file))
+            self.mailmap = read_mailmap(mailmap_file)
+
         self.parts = data.get("parts", {"all": [r"^.*$"]})
 
         self.merge = data.get("merge", [])
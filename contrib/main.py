@@ -6,25 +6,32 @@
 from __future__ import division
 
 import argparse
+import asyncio
 import bisect
 import collections
+import concurrent.futures
 import contextlib
+import cProfile
 import glob
+import hashlib
+import io
 import json
 import sys
 import re
 import os
 import datetime
 import errno
+import sqlite3
 import subprocess
 import string
 import time
 import multiprocessing
+import multiprocessing.pool
+import pstats
+import threading
+import zlib
 
 import dateutil.parser
-import matplotlib.colors
-import matplotlib.pyplot as plt
-import matplotlib.cm as cmx
 
 import contrib.config
 
@@ -32,10 +39,58 @@ import contrib.config
 blame_jobs = multiprocessing.cpu_count()
 blame_pool = None
 
+#: what runs blame jobs: "process" for a multiprocessing pool, "thread"
+#: for a thread pool (blames run in git child processes either way), or
+#: "asyncio" for ``AsyncBlamePool``
+executor = "process"
+
+#: seconds before an asyncio blame is killed (None for no limit)
+blame_timeout = None
+
+#: times an asyncio blame is retried after a timeout or error
+blame_retries = 2
+
+#: (filename, commit, reason) for blames that failed even after retrying
+failed_blames = []
+
+#: most commits that ``_build_index()`` has planned but not yet finished
+index_window = 64
+
+#: per-file counts ``_build_index()`` keeps for reuse by later commits
+index_recent_files = 1 << 16
+
+#: get each commit's file list from a diff against the previously planned
+#: commit instead of listing its whole tree
+incremental = False
+
+#: key under which files that could not be blamed are listed in the
+#: per-commit JSON files; it is never a real author name
+skipped_key = "__skipped__"
+
 # Location to cache per-commit stats in
 cache_dir = "line-data"
 parts_dir = "line-data/parts"
-blame_dir = "line-data/blame"
+blame_store_path = "line-data/blame.sqlite"
+costs_file = "line-data/costs.json"
+history_file = "line-data/history.json"
+
+#: hashes of the data each plot was last rendered from, by plot file
+plots_file = "line-data/plots.json"
+
+#: last commit scanned by ``--update-org-map``, and the orgmap it made
+org_map_scan_file = "line-data/orgmap-scan.json"
+
+#: whether to keep raw ``git blame`` output in the blame store
+keep_blame = False
+
+#: hits and misses in the per-file author count cache
+count_cache_stats = collections.Counter()
+
+#: file to append JSON-lines trace events to (see ``trace()``), or None
+trace_file = None
+
+#: descriptor for ``trace_file`` in each process, by pid
+_trace_fds = {}
 
 # Patterns to ignore
 ignore = [r"^\s*\#", r"^\s*$"]  # comments  # blank lines
@@ -44,9 +99,16 @@ ignore = [re.compile(s) for s in ignore]
 #: global for location of repo
 git_repo_dir = None
 
+#: most tree listings ``GitObjects`` keeps in memory
+git_tree_cache_size = 1 << 14
+
 #: global for verbosity
 verbose = False
 
+#: how to attribute lines: "blame" runs git blame at each sampled commit,
+#: "replay" replays first-parent diffs once (see ``LineReplay``)
+engine = "blame"
+
 
 def die(message):
     sys.stderr.write("==> Error: %s" % message)
@@ -58,11 +120,88 @@ def mkdirp(*paths):
     """Creates a directory, as well as parent directories if needed."""
     for path in paths:
         if not os.path.exists(path):
-            os.makedirs(path)
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                # another blame job may have just created it
+                if e.errno != errno.EEXIST or not os.path.isdir(path):
+                    raise
         elif not os.path.isdir(path):
             raise OSError(errno.EEXIST, "File already exists", path)
 
 
+def temp_path(path):
+    """Name of a temporary file to write before renaming it to ``path``.
+
+    Unique per process and thread, so concurrent blame jobs never write
+    to the same temporary file.
+    """
+    return "%s.tmp.%d.%d" % (path, os.getpid(), threading.get_ident())
+
+
+class LRUCache(object):
+    """Dict-like cache that keeps the ``size`` most recently used entries."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, key):
+        value = self.entries[key]
+        self.entries.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+def trace(event, **fields):
+    """Record an event in ``trace_file``, if tracing is on.
+
+    Each event is a JSON object on its own line, with the event name, the
+    time, the process and thread, and ``fields``.  Events are written with
+    one ``os.write()`` on an append-only descriptor, so pool workers can
+    trace to the same file.
+    """
+    if trace_file is None:
+        return
+
+    fields.update(
+        event=event, time=time.time(), pid=os.getpid(), thread=threading.get_ident()
+    )
+    data = (json.dumps(fields, sort_keys=True) + "\n").encode("utf-8")
+
+    pid = os.getpid()
+    if pid not in _trace_fds:
+        _trace_fds[pid] = os.open(
+            trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+        )
+    os.write(_trace_fds[pid], data)
+
+
+@contextlib.contextmanager
+def traced(event, **fields):
+    """Context manager that traces an event with how long it took.
+
+    Yields ``fields``, so callers can add to them before the event is
+    written.
+    """
+    start = time.time()
+    try:
+        yield fields
+    finally:
+        trace(event, seconds=time.time() - start, **fields)
+
+
 @contextlib.contextmanager
 def working_dir(directory):
     pwd = os.getcwd()
@@ -78,25 +217,87 @@ def git(*args, split=True):
     if verbose:
         print("    " + git_repo_dir + ": " + " ".join(cmd))
 
-    with working_dir(git_repo_dir):
-        output = subprocess.check_output(cmd)
-        output = output.decode("utf-8")
-        if split:
-            output = output.strip().split("\n")
-        return output
+    # pass cwd instead of changing directory, so this is thread-safe
+    with traced("git", args=list(args)) as fields:
+        output = subprocess.check_output(cmd, cwd=git_repo_dir)
+        fields["bytes"] = len(output)
+    output = output.decode("utf-8")
+    if split:
+        output = output.strip().split("\n")
+    return output
 
 
-def git_blame_file(args):
-    commit, filename, cache_file = args
+@contextlib.contextmanager
+def git_stream(*args):
+    """Run a git command and yield an iterator over its output lines.
 
-    if os.path.exists(cache_file):
-        with open(cache_file, "r") as f:
-            return f.read()
+    Lines are decoded and stripped of their trailing newline as they are
+    read, so output is never held in memory all at once.
+
+    When tracing, the ``git`` event's ``wait_seconds`` is the time spent
+    waiting for output; the rest of ``seconds`` went to the caller.
+    """
+    cmd = ["git"]
+    cmd.extend(args)
+
+    if verbose:
+        print("    " + git_repo_dir + ": " + " ".join(cmd))
+
+    start = time.time()
+    proc = subprocess.Popen(cmd, cwd=git_repo_dir, stdout=subprocess.PIPE)
+
+    stdout = io.TextIOWrapper(
+        proc.stdout, encoding="utf-8", errors="replace", newline="\n"
+    )
+    lines = (line.rstrip("\n") for line in stdout)
+    timer = None
+    if trace_file is not None:
+        timer = WaitTimer(lines)
+        lines = timer
+
+    try:
+        yield lines
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+
+    stdout.close()
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    if timer:
+        trace(
+            "git",
+            args=list(args),
+            seconds=time.time() - start,
+            wait_seconds=timer.seconds,
+            lines=timer.count,
+        )
+
+
+class WaitTimer(object):
+    """Iterator wrapper that times how long each ``next()`` blocks."""
+
+    def __init__(self, iterator):
+        self.iterator = iterator
+        self.seconds = 0.0
+        self.count = 0
 
-    parent = os.path.dirname(cache_file)
-    mkdirp(parent)
+    def __iter__(self):
+        return self
 
-    tmp_file = cache_file + (".tmp.%d" % os.getpid())
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self.iterator)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.count += 1
+
+
+def blame_args(commit, filename):
+    """Arguments to ``git`` for blaming one file at a commit."""
     blame_cmd = [
         "blame",
         "-w",
@@ -116,9 +317,27 @@ def git_blame_file(args):
         "--",
         filename,
     ]
+    return blame_cmd
+
+
+def git_blame_file(args):
+    """Run ``git blame`` on one file at a commit and return its output.
+
+    If ``cache_file`` is not ``None``, output is cached there and read
+    back on later calls.
+    """
+    commit, filename, cache_file = args
+
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file, "r") as f:
+            return f.read()
 
-    blame_output = git(*blame_cmd, split=False)
+    blame_output = git(*blame_args(commit, filename), split=False)
+    if not cache_file:
+        return blame_output
 
+    mkdirp(os.path.dirname(cache_file))
+    tmp_file = temp_path(cache_file)
     with open(tmp_file, "w") as stream:
         stream.write(blame_output)
         stream.flush()
@@ -126,145 +345,1539 @@ def git_blame_file(args):
     return blame_output
 
 
-def files_for_commit(commit, places):
-    """Get only files from a commit that match the places list"""
-    files = git("ls-tree", "-r", "--name-only", "--full-tree", commit)
+def git_blame_counts(commit, filename, keep=False):
+    """Stream ``git blame`` for one file and count lines as they arrive.
+
+    Like ``git_blame_file()``, but memory use does not depend on the size
+    of the file.  If ``keep`` is true, the raw output is compressed into
+    the blame store while it is counted, and read back on later calls.
+    """
+    if not keep:
+        with git_stream(*blame_args(commit, filename)) as lines:
+            return count_blame(lines)
+
+    output = blame_store().get_blame(filename, commit)
+    if output is not None:
+        return count_blame(output)
+
+    stream = PackedOutput()
+
+    def tee(lines):
+        for line in lines:
+            stream.write(line)
+            stream.write("\n")
+            yield line
+
+    with git_stream(*blame_args(commit, filename)) as lines:
+        counts = count_blame(tee(lines))
+    blame_store().put_blame(filename, commit, stream.getvalue(), stream.size)
+    return counts
+
+
+class PackedOutput(object):
+    """File-like object that compresses text written to it."""
+
+    def __init__(self):
+        self.compressor = zlib.compressobj()
+        self.chunks = []
+        self.size = 0
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self.size += len(data)
+        self.chunks.append(self.compressor.compress(data))
+
+    def getvalue(self):
+        """Get the compressed data.  Nothing can be written after this."""
+        return b"".join(self.chunks) + self.compressor.flush()
+
+
+class BlameStore(object):
+    """Packed, compressed cache of per-file blame results.
+
+    Author counts for each ``(path, blob)``, and with ``--keep-blame`` the
+    raw ``git blame`` output for each ``(path, commit)``, are stored as
+    zlib-compressed rows in one SQLite database instead of one small file
+    each.  Every row records when it was last used, to within
+    ``used_resolution`` seconds, so ``gc()`` can evict the least recently
+    used ones to fit a size budget.  Per-commit stats in ``parts_dir`` are
+    not stored here and are never evicted.
+    """
+
+    tables = ("counts", "blame")
+
+    #: a hit only rewrites a row's ``used`` time if it is older than this
+    used_resolution = 3600.0
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _db(self):
+        # sqlite connections can't be shared by threads or forked children
+        db = getattr(self.local, "db", None)
+        if db is None or self.local.pid != os.getpid():
+            if os.path.dirname(self.path):
+                mkdirp(os.path.dirname(self.path))
+            db = sqlite3.connect(self.path, timeout=600, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            for table in self.tables:
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS %s (path TEXT, sha1 TEXT, "
+                    "data BLOB, raw_size INTEGER, used REAL, "
+                    "PRIMARY KEY (path, sha1))" % table
+                )
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def _has(self, table, path, sha1):
+        row = (
+            self._db()
+            .execute(
+                "SELECT 1 FROM %s WHERE path = ? AND sha1 = ?" % table, (path, sha1)
+            )
+            .fetchone()
+        )
+        return row is not None
+
+    def _get(self, table, path, sha1):
+        db = self._db()
+        row = db.execute(
+            "SELECT data, used FROM %s WHERE path = ? AND sha1 = ?" % table,
+            (path, sha1),
+        ).fetchone()
+        if row is None:
+            return None
+
+        # most hits are on rows used moments ago; don't write for those
+        data, used = row
+        now = time.time()
+        if now - used > self.used_resolution:
+            db.execute(
+                "UPDATE %s SET used = ? WHERE path = ? AND sha1 = ?" % table,
+                (now, path, sha1),
+            )
+        return zlib.decompress(data).decode("utf-8")
+
+    def _put(self, table, path, sha1, data, raw_size):
+        self._db().execute(
+            "INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?)" % table,
+            (path, sha1, data, raw_size, time.time()),
+        )
+
+    def has_counts(self, path, blob):
+        return self._has("counts", path, blob)
+
+    def get_counts(self, path, blob):
+        """Get cached author counts for a file with some content, or None."""
+        data = self._get("counts", path, blob)
+        return None if data is None else json.loads(data)
+
+    def put_counts(self, path, blob, counts):
+        data = json.dumps(counts).encode("utf-8")
+        self._put("counts", path, blob, zlib.compress(data), len(data))
+
+    def has_blame(self, path, commit):
+        return self._has("blame", path, commit)
+
+    def get_blame(self, path, commit):
+        """Get kept ``git blame`` output for a file at a commit, or None."""
+        return self._get("blame", path, commit)
+
+    def put_blame(self, path, commit, data, raw_size):
+        """Store blame output already compressed by ``PackedOutput``."""
+        self._put("blame", path, commit, data, raw_size)
+
+    def stats(self):
+        """Get entries, packed bytes, and raw bytes for each table."""
+        stats = {}
+        for table in self.tables:
+            entries, packed, raw = (
+                self._db()
+                .execute(
+                    "SELECT COUNT(*), TOTAL(LENGTH(data)), TOTAL(raw_size) FROM %s"
+                    % table
+                )
+                .fetchone()
+            )
+            stats[table] = {"entries": entries, "packed": int(packed), "raw": int(raw)}
+        return stats
+
+    def disk_size(self):
+        """Bytes used on disk by the database and its write-ahead log."""
+        paths = [self.path, self.path + "-wal"]
+        return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+    def gc(self, budget):
+        """Evict least recently used entries until at most ``budget`` bytes
+        of packed data are left, then compact the database if anything was
+        evicted.
+
+        Returns the number of entries evicted and the packed bytes freed.
+        """
+        db = self._db()
+        total = sum(s["packed"] for s in self.stats().values())
+
+        evict = []
+        freed = 0
+        if total > budget:
+            rows = db.execute(
+                " UNION ALL ".join(
+                    "SELECT used, '%s', path, sha1, LENGTH(data) FROM %s" % (t, t)
+                    for t in self.tables
+                )
+                + " ORDER BY 1"
+            )
+            for _, table, path, sha1, size in rows:
+                if total - freed <= budget:
+                    break
+                evict.append((table, path, sha1))
+                freed += size
+            rows.close()
+
+        if evict:
+            db.execute("BEGIN")
+            for table, path, sha1 in evict:
+                db.execute(
+                    "DELETE FROM %s WHERE path = ? AND sha1 = ?" % table, (path, sha1)
+                )
+            db.execute("COMMIT")
+
+            db.execute("VACUUM")
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return len(evict), freed
+
+    def pack(self, counts_dir, blame_dir):
+        """Move loose files from older versions of contrib into the store.
+
+        ``counts_dir`` has ``<path>/<blob>.json`` files of author counts,
+        and ``blame_dir`` has ``<path>/<commit>.txt`` files of raw blame
+        output.  Each file is removed once stored.  Returns how many
+        files were packed.
+        """
+        packed = 0
+        for directory, suffix in ((counts_dir, ".json"), (blame_dir, ".txt")):
+            if not os.path.isdir(directory):
+                continue
+
+            for root, dirs, files in os.walk(directory, topdown=False):
+                for name in files:
+                    sha1, ext = os.path.splitext(name)
+                    if ext != suffix or not re.match(r"^[0-9a-f]{40}$", sha1):
+                        continue
+
+                    file_path = os.path.join(root, name)
+                    path = os.path.relpath(root, directory).replace(os.sep, "/")
+                    with open(file_path, "rb") as f:
+                        data = f.read()
+                    if suffix == ".json":
+                        self.put_counts(path, sha1, json.loads(data.decode("utf-8")))
+                    else:
+                        self.put_blame(path, sha1, zlib.compress(data), len(data))
+                    os.remove(file_path)
+                    packed += 1
+
+                if not os.listdir(root):
+                    os.rmdir(root)
+        return packed
+
+    def close(self):
+        db = getattr(self.local, "db", None)
+        if db is not None and self.local.pid == os.getpid():
+            db.close()
+        self.local = threading.local()
+
+
+#: shared BlameStore for ``blame_store_path``; see ``blame_store()``
+_blame_store = None
+
+
+def blame_store():
+    """Get the shared ``BlameStore`` at the current ``blame_store_path``.
+
+    Loose cache files left in ``cache_dir`` by older versions of contrib
+    are packed into the store the first time it is opened.
+    """
+    global _blame_store
+    path = os.path.abspath(blame_store_path)
+    if _blame_store is None or _blame_store.path != path:
+        _blame_store = BlameStore(path)
+
+        counts = os.path.join(cache_dir, "counts")
+        blame = os.path.join(cache_dir, "blame")
+        if os.path.isdir(counts) or os.path.isdir(blame):
+            packed = _blame_store.pack(counts, blame)
+            if packed:
+                print(
+                    "==> Packed %d loose cache files into '%s'."
+                    % (packed, blame_store_path)
+                )
+    return _blame_store
+
+
+class GitObjects(object):
+    """Answers object lookups from one long-lived ``git cat-file --batch``.
+
+    Resolving revisions, reading commit dates, and listing trees would
+    otherwise fork a git process per query.  Results are memoized, since
+    objects never change; names like ``HEAD`` that can move are looked up
+    again each time.
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.proc = None
+        self.pid = None
+        self.shas = {}
+        self.dates = {}
+        self.object_sizes = {}
+        self.trees = LRUCache(git_tree_cache_size)
+        self.reads = 0
+        self.read_seconds = 0.0
+
+    def _process(self):
+        # restart in forked children; they can't share the parent's pipes
+        if self.proc is None or self.pid != os.getpid():
+            cmd = ["git", "cat-file", "--batch"]
+            if verbose:
+                print("    " + self.repo + ": " + " ".join(cmd))
+            self.proc = subprocess.Popen(
+                cmd, cwd=self.repo, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+            )
+            self.pid = os.getpid()
+        return self.proc
+
+    def close(self):
+        if self.proc is not None and self.pid == os.getpid():
+            # forked pool workers may hold stdin open, so EOF is not enough
+            self.proc.stdin.close()
+            self.proc.terminate()
+            self.proc.wait()
+            self.proc.stdout.close()
+        self.proc = None
+
+    def read(self, rev):
+        """Get a (sha1, type, content) tuple for any revision expression."""
+        start = time.perf_counter()
+        proc = self._process()
+        proc.stdin.write(rev.encode("utf-8") + b"\n")
+        proc.stdin.flush()
+
+        header = proc.stdout.readline().decode("utf-8").split()
+        if len(header) != 3:
+            raise ValueError("no such object in %s: %s" % (self.repo, rev))
+        sha1, kind, size = header
+
+        content = proc.stdout.read(int(size))
+        proc.stdout.read(1)  # trailing newline
+
+        self.reads += 1
+        self.read_seconds += time.perf_counter() - start
+        return sha1, kind, content
+
+    def rev_parse(self, rev):
+        """Get the full sha1 of the commit that ``rev`` refers to."""
+        if rev in self.shas:
+            return self.shas[rev]
+
+        sha1, _, _ = self.read(rev + "^{commit}")
+        if re.match(r"^[0-9a-f]{40}$", rev):
+            self.shas[rev] = sha1  # refs and other names can move
+        return sha1
+
+    def commit_date(self, commit):
+        """Get the committer date of a commit as an aware datetime."""
+        if commit not in self.dates:
+            _, _, content = self.read(commit + "^{commit}")
+            for line in content.decode("utf-8", "replace").split("\n"):
+                if line.startswith("committer "):
+                    timestamp, tz = line.rsplit(" ", 2)[1:]
+                    break
+                if not line:
+                    raise ValueError("commit has no committer: %s" % commit)
+
+            sign = -1 if tz.startswith("-") else 1
+            offset = datetime.timedelta(hours=int(tz[1:3]), minutes=int(tz[3:5]))
+            tzinfo = datetime.timezone(sign * offset)
+            self.dates[commit] = datetime.datetime.fromtimestamp(int(timestamp), tzinfo)
+        return self.dates[commit]
+
+    def tree_entries(self, tree):
+        """Get a list of (name, sha1, is_tree) for the entries of a tree.
+
+        ``tree`` is a sha1 or an expression like ``HEAD^{tree}``.  The
+        most recently used listings are memoized by tree sha1 (see
+        ``git_tree_cache_size``), so a subtree that is the same in many
+        commits is only parsed once.  Submodules are left out.
+        """
+        if tree in self.trees:
+            return self.trees[tree]
+
+        sha1, _, content = self.read(tree)
+        if sha1 not in self.trees:
+            entries = []
+            pos = 0
+            while pos < len(content):
+                space = content.index(b" ", pos)
+                nul = content.index(b"\0", space)
+                mode = content[pos:space]
+                name = content[space + 1 : nul].decode("utf-8", "replace")
+                entry_sha1 = content[nul + 1 : nul + 21].hex()
+                pos = nul + 21
+
+                if mode != b"160000":  # skip submodules
+                    entries.append((name, entry_sha1, mode == b"40000"))
+            self.trees[sha1] = entries
+        return self.trees[sha1]
+
+    def ls_tree(self, commit, prefixes=None):
+        """Get a list of (path, blob sha1) tuples for all files in a commit.
+
+        If ``prefixes`` is a list of directory prefixes like ``lib/``, only
+        files under them are listed, and other subtrees are never read.
+        """
+        results = []
+
+        def walk(tree, prefix, inside):
+            for name, sha1, is_tree in self.tree_entries(tree):
+                path = prefix + name
+                if not is_tree:
+                    if inside:
+                        results.append((path, sha1))
+                    continue
+
+                path += "/"
+                below = inside or any(path.startswith(p) for p in prefixes)
+                if below or any(p.startswith(path) for p in prefixes):
+                    walk(sha1, path, below)
+
+        walk(commit + "^{tree}", "", prefixes is None)
+        return results
+
+    def sizes(self, shas):
+        """Get a dictionary of sizes of many objects.
+
+        Sizes not already known are looked up with a single
+        ``git cat-file --batch-check`` call.
+        """
+        todo = sorted(set(sha1 for sha1 in shas if sha1 not in self.object_sizes))
+        if todo:
+            output = subprocess.run(
+                ["git", "cat-file", "--batch-check"],
+                cwd=self.repo,
+                input="\n".join(todo) + "\n",
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+                check=True,
+            ).stdout
+            for line in output.splitlines():
+                sha1, _, size = line.split()
+                self.object_sizes[sha1] = int(size)
+        return dict((sha1, self.object_sizes[sha1]) for sha1 in shas)
+
+
+#: shared GitObjects instance for ``git_repo_dir``; see ``git_objects()``
+_git_objects = None
+
+
+def git_objects():
+    """Get the shared ``GitObjects`` reader for the current repository."""
+    global _git_objects
+    if _git_objects is None or _git_objects.repo != git_repo_dir:
+        if _git_objects is not None:
+            _git_objects.close()
+        _git_objects = GitObjects(git_repo_dir)
+    return _git_objects
+
+
+def ls_tree(commit, prefixes=None):
+    """Get a list of (path, blob sha1) tuples for files in a commit.
+
+    See ``GitObjects.ls_tree()`` for ``prefixes``.
+    """
+    return git_objects().ls_tree(commit, prefixes)
+
+
+def literal_prefix(regex):
+    """Get the directory that every path matching ``regex`` must be in.
+
+    E.g., ``lib/`` for ``^lib/.*\\.py$``.  Returns ``""`` if the regex is
+    not anchored, or if it is too complicated to tell.
+    """
+    pattern = regex.pattern
+    if regex.flags & (re.IGNORECASE | re.VERBOSE) or "|" in pattern:
+        return ""
+    if not pattern.startswith("^"):
+        return ""
+
+    literal = []
+    i = 1
+    while i < len(pattern):
+        char, step = pattern[i], 1
+        if char == "\\":
+            if i + 1 == len(pattern) or pattern[i + 1].isalnum():
+                break  # a class like \d, or a backreference
+            char, step = pattern[i + 1], 2
+        elif char in ".^$*+?{}[]()":
+            break
+
+        # a quantifier may make this character optional
+        quantifier = pattern[i + step : i + step + 1]
+        if quantifier and quantifier in "*?{":
+            break
+        literal.append(char)
+        if quantifier == "+":
+            break
+        i += step
+
+    literal = "".join(literal)
+    return literal[: literal.rfind("/") + 1]
+
+
+def place_prefixes(places):
+    """Get directory prefixes that contain every file matching ``places``.
+
+    Returns ``None`` if some place could match anywhere in the tree.
+    """
+    prefixes = set(literal_prefix(regex) for regex in places)
+    if "" in prefixes:
+        return None
+
+    # drop prefixes inside other prefixes
+    return sorted(
+        p for p in prefixes if not any(p != q and p.startswith(q) for q in prefixes)
+    )
+
+
+def files_for_commit(commit, places, tree=None):
+    """Get only files from a commit that match the places list
+
+    Each file is listed once, even if it matches several places.
+    """
+    if tree is None:
+        tree = ls_tree(commit, place_prefixes(places))
+    files = [path for path, _ in tree]
     results = []
+    seen = set()
     for regex in places:
-        results.extend(f for f in files if regex.search(f))
+        for f in files:
+            if f not in seen and regex.search(f):
+                results.append(f)
+                seen.add(f)
     return results
 
 
+def changed_files(old, new, prefixes=None):
+    """Get the files that differ between two commits.
+
+    Returns a dictionary mapping each changed path to its blob sha1 in
+    ``new``, or to ``None`` if it was deleted.  If ``prefixes`` is given,
+    only files under those directories are compared.
+    """
+    args = ["diff", "--raw", "-z", "--no-abbrev", "--no-renames", old, new]
+    if prefixes is not None:
+        args.append("--")
+        args.extend(prefixes)
+
+    fields = git(*args, split=False).split("\0")
+    changes = {}
+    for meta, path in zip(fields[0:-1:2], fields[1::2]):
+        _, new_mode, _, blob, status = meta.split()
+        if new_mode == "160000":
+            continue  # submodules are not listed by ls_tree() either
+        changes[path] = None if status == "D" else blob
+    return changes
+
+
 def iter_blame(output):
-    """Parses ``git blame --line-porcelain`` output."""
-    commit = author = None
-    for line in output.strip().split("\n"):
+    """Parses ``git blame --line-porcelain`` output.
+
+    ``output`` is either the full output as a string, or an iterable of
+    lines without trailing newlines, e.g. from ``git_stream()``.
+    """
+    if isinstance(output, str):
+        output = output.strip().split("\n")
+
+    parser = BlameParser()
+    for line in output:
+        result = parser.feed(line)
+        if result:
+            yield result
+
+
+class BlameParser(object):
+    """Parses ``git blame --line-porcelain`` output one line at a time."""
+
+    def __init__(self):
+        self.commit = self.author = None
+
+    def feed(self, line):
+        """Return (commit, author, text) for a content line, else None."""
         if line.startswith("author "):
-            author = line[7:]
+            self.author = line[7:]
 
         elif line.startswith("\t"):
-            text = line[1:]
-            yield (commit, author, text)
+            return (self.commit, self.author, line[1:])
 
         else:
             prefix = line[:40]
             if " " not in prefix and all(c in string.hexdigits for c in prefix):
-                commit = prefix
+                self.commit = prefix
+
+
+def is_ignored(text):
+    """Whether a line of code matches one of the ``ignore`` patterns."""
+    return any(ig.search(text) for ig in ignore)
+
+
+def count_blame(output):
+    """Count non-ignored lines per author in ``git blame`` output.
+
+    ``output`` can be anything ``iter_blame()`` accepts.
+    """
+    counts = {}
+    for _, author, line in iter_blame(output):
+        if not is_ignored(line):
+            counts[author] = counts.get(author, 0) + 1
+    return counts
+
+
+def sum_counts(count_dicts):
+    """Add up a sequence of author-to-line-count dictionaries."""
+    total = {}
+    for counts in count_dicts:
+        for author, count in counts.items():
+            total[author] = total.get(author, 0) + count
+    return total
+
+
+def blame_task(args):
+    """Pool task: get author counts for one file at one commit.
+
+    Blame output is parsed and counted in the worker, so only the small
+    author-to-count mapping is sent back to the parent.  Counts are
+    cached by path and blob sha1, so a file is only blamed again if its
+    content changes.  Returns a tuple of the filename, blob, its counts,
+    whether they came from the cache, how long the task took, and when it
+    finished.
+    """
+    commit, filename, blob = args
+    start = time.time()
+
+    counts = blame_store().get_counts(filename, blob)
+    if counts is not None:
+        end = time.time()
+        return filename, blob, counts, True, end - start, end
+
+    counts = git_blame_counts(commit, filename, keep_blame)
+    blame_store().put_counts(filename, blob, counts)
+
+    end = time.time()
+    return filename, blob, counts, False, end - start, end
+
+
+def format_duration(seconds):
+    """Format a number of seconds like 1h02m, 3m05s, or 12s."""
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return "%dh%02dm" % (seconds // 3600, seconds % 3600 // 60)
+    elif seconds >= 60:
+        return "%dm%02ds" % (seconds // 60, seconds % 60)
+    return "%ds" % seconds
+
+
+def format_size(size):
+    """Format a number of bytes like 1.5G, 320M, 12K, or 100B."""
+    for unit, scale in (("G", 1 << 30), ("M", 1 << 20), ("K", 1 << 10)):
+        if size >= scale:
+            value = size / scale
+            return ("%.1f%s" if value < 10 else "%d%s") % (value, unit)
+    return "%dB" % size
+
+
+class BlameCosts(object):
+    """Estimates how long blame tasks will take.
+
+    Uses the time each file took to blame in earlier runs, if it was
+    recorded, and otherwise scales the file's size by the average time
+    per byte of everything recorded so far.
+    """
+
+    #: seconds per byte to assume before anything has been recorded
+    default_rate = 1e-5
+
+    def __init__(self, path):
+        self.path = path
+        self.costs = {}  # filename -> [seconds, size]
+        if os.path.exists(path):
+            with open(path) as f:
+                self.costs = json.load(f)
+        self.rate = self._rate()
+
+    def _rate(self):
+        seconds = sum(c[0] for c in self.costs.values())
+        size = sum(c[1] for c in self.costs.values())
+        return seconds / size if seconds and size else self.default_rate
+
+    def estimate(self, filename, size):
+        """Estimated seconds to blame a file of some size."""
+        if filename in self.costs:
+            return self.costs[filename][0]
+        return size * self.rate
+
+    def record(self, filename, size, seconds):
+        self.costs[filename] = [seconds, size]
+
+    def save(self):
+        if os.path.dirname(self.path):
+            mkdirp(os.path.dirname(self.path))
+        temp_name = "%s.tmp.%d" % (self.path, os.getpid())
+        with open(temp_name, "w") as temp:
+            json.dump(self.costs, temp)
+        os.rename(temp_name, self.path)
+
+
+def schedule_blames(tasks, costs):
+    """Order blame tasks so that the most expensive ones start first.
+
+    ``tasks`` is a list of ``(commit, filename, blob)`` arguments for
+    ``blame_task()``.  Returns the sorted tasks, a dictionary of their
+    estimated costs keyed by ``(filename, blob)``, and a dictionary of
+    blob sizes.  Tasks whose counts are already cached cost nothing.
+    """
+    sizes = git_objects().sizes([blob for _, _, blob in tasks])
+
+    estimates = {}
+    for _, filename, blob in tasks:
+        if blame_store().has_counts(filename, blob):
+            estimates[filename, blob] = 0.0
+        else:
+            estimates[filename, blob] = costs.estimate(filename, sizes[blob])
+
+    tasks = sorted(tasks, key=lambda t: estimates[t[1], t[2]], reverse=True)
+    return tasks, estimates, sizes
+
+
+async def async_blame_counts(commit, filename, keep=False):
+    """asyncio version of ``git_blame_counts()``.
+
+    The git process is killed if the coroutine is cancelled, e.g. by a
+    timeout in ``asyncio.wait_for()``.
+    """
+    if keep and blame_store().has_blame(filename, commit):
+        return git_blame_counts(commit, filename, keep)
+
+    cmd = ["git"] + blame_args(commit, filename)
+    if verbose:
+        print("    " + git_repo_dir + ": " + " ".join(cmd))
+
+    stream = PackedOutput() if keep else None
+
+    start = time.time()
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, cwd=git_repo_dir, stdout=asyncio.subprocess.PIPE
+    )
+    try:
+        parser = BlameParser()
+        counts = {}
+        rest = b""
+        while True:
+            # read in large chunks; awaiting each line separately is slow
+            chunk = await proc.stdout.read(1 << 16)
+            if chunk:
+                lines = (rest + chunk).split(b"\n")
+                rest = lines.pop()
+            else:
+                lines = [rest] if rest else []
+
+            for line in lines:
+                line = line.decode("utf-8", "replace")
+                if stream:
+                    stream.write(line)
+                    stream.write("\n")
+
+                result = parser.feed(line)
+                if result and not is_ignored(result[2]):
+                    counts[result[1]] = counts.get(result[1], 0) + 1
+
+            if not chunk:
+                break
+
+        if await proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+    trace("git", args=cmd[1:], seconds=time.time() - start)
+    if stream:
+        blame_store().put_blame(filename, commit, stream.getvalue(), stream.size)
+    return counts
+
+
+async def async_blame_task(args):
+    """asyncio version of ``blame_task()``, with timeouts and retries.
+
+    Each attempt gets ``blame_timeout`` seconds, and a failed blame is
+    retried up to ``blame_retries`` times.  If every attempt fails, the
+    file is added to ``failed_blames`` and its counts are ``None``.
+    """
+    commit, filename, blob = args
+    start = time.time()
+
+    counts = blame_store().get_counts(filename, blob)
+    if counts is not None:
+        end = time.time()
+        return filename, blob, counts, True, end - start, end
+
+    for attempt in range(blame_retries + 1):
+        try:
+            counts = await asyncio.wait_for(
+                async_blame_counts(commit, filename, keep_blame), blame_timeout
+            )
+            break
+        except asyncio.TimeoutError:
+            reason = "timed out after %ss" % blame_timeout
+        except subprocess.CalledProcessError as e:
+            reason = "git blame exited with status %d" % e.returncode
+    else:
+        failed_blames.append((filename, commit, reason))
+        end = time.time()
+        return filename, blob, None, False, end - start, end
+
+    blame_store().put_counts(filename, blob, counts)
+
+    end = time.time()
+    return filename, blob, counts, False, end - start, end
+
+
+class AsyncBlamePool(object):
+    """Runs coroutine tasks on an asyncio event loop, ``jobs`` at a time.
+
+    Provides the ``imap_unordered()`` method contrib uses from
+    ``multiprocessing.Pool``, but ``func`` must be a coroutine function,
+    e.g. ``async_blame_task()``.  The event loop runs in the calling
+    thread, a step at a time, as results are consumed.
+
+    Like a ``multiprocessing.Pool``, the iterable is read in another
+    thread, so it may block until results already yielded are handled.
+    It is only read when fewer than ``jobs`` tasks are running.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def imap_unordered(self, func, iterable):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        reader = concurrent.futures.ThreadPoolExecutor(1)
+        iterator = iter(iterable)
+        end = object()
+
+        def fetch():
+            return loop.run_in_executor(reader, next, iterator, end)
+
+        fetching = fetch()
+        running = set()
+        try:
+            while fetching is not None or running:
+                waiting = running if fetching is None else running | {fetching}
+                done, _ = loop.run_until_complete(
+                    asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                )
+                if fetching in done:
+                    done.discard(fetching)
+                    args = fetching.result()
+                    fetching = None
+                    if args is end:
+                        iterator = None
+                    else:
+                        running.add(loop.create_task(func(args)))
+
+                for future in done:
+                    running.discard(future)
+                    yield future.result()
+
+                if fetching is None and iterator is not None:
+                    if len(running) < self.jobs:
+                        fetching = fetch()
+        finally:
+            for future in running:
+                future.cancel()
+            if running:
+                loop.run_until_complete(asyncio.wait(running))
+            if fetching is not None:
+                fetching.cancel()
+            # don't wait for a read that is blocked on the caller
+            reader.shutdown(wait=False)
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def terminate(self):
+        pass
+
+
+class BlameProgress(object):
+    """Prints a progress line as blame tasks complete.
+
+    The time remaining is estimated from how fast the estimated cost of
+    finished tasks (see ``BlameCosts``) is being worked off.  If tasks are
+    added a commit at a time, as earlier ones finish, set ``commits`` to
+    the number of commits being indexed, call ``add()`` once per commit,
+    and count finished ones in ``commits_done``.  Commits not added yet
+    are then assumed to cost as much as the average added commit after
+    the first, which blames every file that later ones share.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.total = 0
+        self.total_cost = 0.0
+        self.done = 0
+        self.done_cost = 0.0
+        self.hits = 0
+        self.commits = 0
+        self.commits_done = 0
+        self.planned = 0
+        self.first_cost = 0.0
+        self.start = time.time()
+        self.line = ""
+
+    def add(self, total, total_cost):
+        """Add ``total`` tasks with estimated cost ``total_cost``."""
+        self.total += total
+        self.total_cost += total_cost
+        self.planned += 1
+        if self.planned == 1:
+            self.first_cost = total_cost
+
+    def update(self, cached, cost=1.0):
+        self.done += 1
+        self.done_cost += cost
+        self.hits += cached
+
+        elapsed = time.time() - self.start
+        if self.done == self.total and self.commits_done == self.commits:
+            remaining = "done in %s" % format_duration(elapsed)
+        elif self.done_cost > 0:
+            left_cost = self.total_cost - self.done_cost
+            unplanned = self.commits - self.planned
+            if unplanned > 0 and self.planned > 1:
+                per_commit = (self.total_cost - self.first_cost) / (self.planned - 1)
+                left_cost += unplanned * per_commit
+            left = elapsed * left_cost / self.done_cost
+            remaining = "~%s left" % format_duration(left)
+        else:
+            remaining = "estimating"
+
+        self.line = "    %s: processed %d/%d blames (%d cached, %s)     " % (
+            self.name,
+            self.done,
+            self.total,
+            self.hits,
+            remaining,
+        )
+        if not verbose:
+            # write summary here (verbose prints out all git commands)
+            sys.stdout.write("\r" + self.line)
+            sys.stdout.flush()
+
+    def message(self, text):
+        """Print a line of text above the progress line."""
+        if verbose:
+            print(text)
+            return
+        sys.stdout.write("\r%s\n%s" % (text.ljust(len(self.line)), self.line))
+        sys.stdout.flush()
+
+    def finish(self):
+        count_cache_stats["hits"] += self.hits
+        count_cache_stats["misses"] += self.done - self.hits
+
+        if self.line and not verbose:
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+
+
+class BlameSchedule(object):
+    """Blame tasks that have been scheduled and are not finished yet.
+
+    ``add()`` orders new tasks largest-first with ``schedule_blames()``
+    and adds them to a ``BlameProgress``.  What was worked out for each
+    task is kept until ``pop()`` is called for its result.
+    """
+
+    def __init__(self, progress):
+        self.progress = progress
+        self.costs = BlameCosts(costs_file)
+        self.pending = {}  # (filename, blob) -> (commit, size, estimate)
+
+    def add(self, tasks):
+        """Schedule ``(commit, filename, blob)`` tasks; return them in order."""
+        tasks, estimates, sizes = schedule_blames(tasks, self.costs)
+        for commit, filename, blob in tasks:
+            estimate = estimates[filename, blob]
+            self.pending[filename, blob] = (commit, sizes[blob], estimate)
+        self.progress.add(len(tasks), sum(estimates.values()))
+        return tasks
+
+    def pop(self, filename, blob):
+        """Get ``(commit, size, estimate)`` for a finished task."""
+        return self.pending.pop((filename, blob))
+
+
+def run_blames(tasks, progress, schedule=None):
+    """Run blame tasks largest-first and yield results as they finish.
+
+    Yields ``(filename, blob, counts)`` tuples, reports progress to a
+    ``BlameProgress``, and records how long each blame took for future
+    scheduling.  ``counts`` is ``None`` for files that could not be
+    blamed (see ``async_blame_task()``).
+
+    ``tasks`` is a list of tasks to schedule here, or, with a
+    ``BlameSchedule``, an iterable of tasks already added to it.
+    """
+    if schedule is None:
+        schedule = BlameSchedule(progress)
+        tasks = schedule.add(tasks)
+
+    task = blame_task
+    if isinstance(blame_pool, AsyncBlamePool):
+        task = async_blame_task
+
+    results = blame_pool.imap_unordered(task, tasks)
+    try:
+        for filename, blob, counts, cached, seconds, finished in results:
+            commit, size, estimate = schedule.pop(filename, blob)
+            trace(
+                "blame",
+                file=filename,
+                blob=blob,
+                size=size,
+                cached=cached,
+                failed=counts is None,
+                seconds=seconds,
+                queue_seconds=time.time() - finished,
+            )
+            if counts is None:
+                reason = next(
+                    r
+                    for f, c, r in reversed(failed_blames)
+                    if (f, c) == (filename, commit)
+                )
+                progress.message("    SKIPPED %s: %s" % (filename, reason))
+            elif not cached:
+                schedule.costs.record(filename, size, seconds)
+            progress.update(cached, estimate)
+            yield filename, blob, counts
+    finally:
+        progress.finish()
+        schedule.costs.save()
+
+
+def blame_commit(commit, places, name):
+    """Blame all files in a place list at one commit.
+
+    Returns an author-to-line-count dictionary, and a sorted list of the
+    files that could not be blamed.
+    """
+    tree = ls_tree(commit, place_prefixes(places))
+    blobs = dict(tree)
+    files = files_for_commit(commit, places, tree)
+    arguments = [(commit, filename, blobs[filename]) for filename in files]
+
+    blame = {}
+    skipped = []
+    for filename, _, counts in run_blames(arguments, BlameProgress(name)):
+        if counts is None:
+            skipped.append(filename)
+            continue
+        for author, count in counts.items():
+            blame[author] = blame.get(author, 0) + count
+    return blame, sorted(skipped)
 
 
 def git_blame(commit, places, name):
-    """Get blame statsistics for all files in a place list."""
-    files = files_for_commit(commit, places)
+    """Get blame statsistics for all files in a place list.
+
+    Files that could not be blamed are listed under ``skipped_key``.
+    """
+    blame, skipped = blame_commit(commit, places, name)
+    if skipped:
+        blame[skipped_key] = skipped
+    return blame
+
+
+class CacheManifest(object):
+    """Index of every commit whose stats are cached in ``parts_dir``.
+
+    Records the commit, its date, the part, and how many files and lines
+    the part had.  With this, deciding what is already cached takes one
+    read of one file, and fuzzing needs no git calls.
+
+    The manifest is a JSON-lines file that is only ever appended to, one
+    ``os.write()`` per record, so concurrent writers can't corrupt it.
+    Caches from before the manifest existed are scanned once to build it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # (part, commit) -> record
+
+        if os.path.exists(path):
+            self._load()
+        else:
+            self._rebuild()
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # partly written by a process that was killed
+                self.entries[record["part"], record["commit"]] = record
+
+    def _rebuild(self):
+        parts = os.path.dirname(self.path)
+        if not os.path.isdir(parts):
+            return
+
+        for part in sorted(os.listdir(parts)):
+            if not os.path.isdir(os.path.join(parts, part)):
+                continue
+            for filename in sorted(os.listdir(os.path.join(parts, part))):
+                match = re.match(r"^([0-9a-f]{40})\.json$", filename)
+                if not match:
+                    continue
+                commit = match.group(1)
+                with open(os.path.join(parts, part, filename)) as f:
+                    stats = json.load(f)
+                if skipped_key in stats:
+                    continue  # incomplete; it will be indexed again
+                try:
+                    date = git_objects().commit_date(commit)
+                except ValueError:
+                    continue  # not in this repository
+                self.entries[part, commit] = self._record(
+                    part, commit, date, None, sum(stats.values())
+                )
+
+        if self.entries:
+            temp_name = temp_path(self.path)
+            with open(temp_name, "w") as temp:
+                for key in sorted(self.entries):
+                    temp.write(json.dumps(self.entries[key]) + "\n")
+            os.rename(temp_name, self.path)
+
+    def _record(self, part, commit, date, files, lines):
+        return {
+            "part": part,
+            "commit": commit,
+            "date": date.isoformat(),
+            "files": files,
+            "lines": lines,
+        }
+
+    def __contains__(self, key):
+        """Whether a ``(part, commit)`` pair is cached."""
+        return key in self.entries
+
+    def get(self, part, commit):
+        return self.entries.get((part, commit))
+
+    def add(self, part, commit, date, files, lines):
+        """Record that stats for a part at a commit have been cached."""
+        record = self._record(part, commit, date, files, lines)
+        self.add_record(record)
+
+    def add_record(self, record):
+        data = (json.dumps(record) + "\n").encode("utf-8")
+
+        parent = os.path.dirname(self.path)
+        if parent:
+            mkdirp(parent)
+        fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # don't glue this record onto one a killed process left unfinished
+            size = os.fstat(fd).st_size
+            if size and os.pread(fd, 1, size - 1) != b"\n":
+                data = b"\n" + data
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+        self.entries[record["part"], record["commit"]] = record
+
+    def commits(self, part):
+        """Get a list of (commit, date) for all cached commits of a part."""
+        return [
+            (commit, parse_date(record["date"]))
+            for (p, commit), record in self.entries.items()
+            if p == part
+        ]
+
+
+#: shared CacheManifest for ``parts_dir``; see ``cache_manifest()``
+_cache_manifest = None
+
+
+def cache_manifest():
+    """Get the shared ``CacheManifest`` for the current ``parts_dir``."""
+    global _cache_manifest
+    path = os.path.abspath(os.path.join(parts_dir, "manifest.jsonl"))
+    if _cache_manifest is None or _cache_manifest.path != path:
+        _cache_manifest = CacheManifest(path)
+    return _cache_manifest
+
+
+class AuthorStats(object):
+    """Cache of line stats by commit."""
+
+    def __init__(self, name, places):
+        self.name = name
+        self.commits = {}
+        self.places = places
+        self.cache = os.path.join(parts_dir, name)
+        if not os.path.isdir(self.cache):
+            mkdirp(self.cache)
+
+    def _path(self, sha1):
+        return os.path.join(self.cache, "%s.json" % sha1)
+
+    def _sha1(self, commit):
+        return git_objects().rev_parse(commit)
+
+    def __contains__(self, commit):
+        sha1 = self._sha1(commit)
+        if sha1 in self.commits or (self.name, sha1) in cache_manifest():
+            return True
+
+        # a run may have been killed between writing the JSON file and
+        # recording it in the manifest
+        path = self._path(sha1)
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path) as f:
+                stats = json.load(f)
+        except ValueError:
+            return False  # partly written
+        if skipped_key in stats:
+            return False
+
+        date = git_objects().commit_date(sha1)
+        cache_manifest().add(self.name, sha1, date, None, sum(stats.values()))
+        return True
+
+    def __getitem__(self, commit):
+        """Get author-to-line-mapping for a SHA1 hash"""
+        sha1 = self._sha1(commit)
+        if sha1 in self.commits:
+            return self.commits[sha1]
+
+        path = self._path(sha1)
+        if os.path.exists(path):
+            with open(path) as f:
+                stats = json.load(f)
+        else:
+            stats, skipped = blame_commit(sha1, self.places, self.name)
+            self.update(sha1, stats, skipped)
+
+        stats.pop(skipped_key, None)
+        self.commits[sha1] = stats
+        return stats
+
+    def update(self, sha1, stats, skipped=None, files=None):
+        """Record author-to-line-mapping computed elsewhere for a SHA1 hash
+
+        Files in ``skipped`` could not be blamed; they are listed in the
+        JSON file under ``skipped_key``, and the commit is left out of the
+        cache manifest so that the next run indexes it again.  ``files``
+        is the number of files in the part, for the cache manifest.
+        """
+        stats = dict(stats)
+        lines = sum(n for a, n in stats.items() if a != skipped_key)
+        if skipped:
+            stats[skipped_key] = sorted(skipped)
+
+        path = self._path(sha1)
+        temp_name = path + ".tmp"
+        with open(temp_name, "w") as temp:
+            json.dump(stats, temp, indent=True, separators=(",", ": "))
+        os.rename(temp_name, path)
+
+        if not skipped:
+            date = git_objects().commit_date(sha1)
+            cache_manifest().add(self.name, sha1, date, files, lines)
+
+        stats.pop(skipped_key, None)
+        self.commits[sha1] = stats
+
+
+class IdentityResolver(object):
+    """Maps author names from blame to canonical names and organizations.
+
+    Names are first mapped by ``mailmap`` (a dict from ``read_mailmap()``),
+    then by ``merge_list`` (see ``merge_map()``).  An author's organization
+    comes from ``authors_to_orgs``, by their own name or else by their
+    canonical one, and is "unknown" if neither is mapped.  Each name is
+    resolved once and remembered, so build one resolver per run.
+    """
+
+    def __init__(self, merge_list=(), authors_to_orgs=None, mailmap=None):
+        self.mailmap = mailmap or {}
+        self.merged = merge_map(merge_list)
+        self.authors_to_orgs = authors_to_orgs or {}
+        self.identities = {}
+        self.orgs = {}
+
+        # identifies the mappings, for caches of resolved stats
+        sha1 = hashlib.sha1()
+        for mapping in (self.mailmap, self.merged, self.authors_to_orgs):
+            sha1.update(json.dumps(sorted(mapping.items())).encode("utf-8"))
+        self.key = sha1.hexdigest()
+
+    def identity(self, author):
+        """Canonical name of ``author``."""
+        if author not in self.identities:
+            name = self.mailmap.get(author, author)
+            self.identities[author] = self.merged.get(name, name)
+        return self.identities[author]
+
+    def org(self, author):
+        """Organization of ``author``, or "unknown" if it is not known."""
+        if author not in self.orgs:
+            org = self.authors_to_orgs.get(author)
+            if org is None:
+                org = self.authors_to_orgs.get(self.identity(author), "unknown")
+            if org.startswith("unknown"):
+                org = "unknown"
+            self.orgs[author] = org
+        return self.orgs[author]
+
+    def _resolve(self, stats, names, lookup):
+        resolved = {}
+        for author, count in stats.items():
+            name = names[author] if author in names else lookup(author)
+            resolved[name] = resolved.get(name, 0) + count
+        return resolved
+
+    def authors(self, stats):
+        """Sum a dict of line counts by author into counts by canonical name."""
+        return self._resolve(stats, self.identities, self.identity)
+
+    def organizations(self, stats):
+        """Sum a dict of line counts by author into counts by organization."""
+        return self._resolve(stats, self.orgs, self.org)
+
+
+class OrgStats(object):
+    """Line stats by organization, for commits in an ``AuthorStats``.
+
+    Resolved stats are cached in ``orgs.json`` next to the part's
+    per-commit JSON files, along with the resolver's key; the cache is
+    discarded if the merge list, orgmap, or mailmap changes.  An entry is
+    recomputed if its total no longer matches the commit's line count in
+    the cache manifest, i.e. if the commit's author stats were replaced.
+    Commits with files that could not be blamed are not cached.  Call
+    ``save()`` to write new entries.
+    """
+
+    def __init__(self, author_stats, resolver):
+        self.author_stats = author_stats
+        self.resolver = resolver
+        self.path = os.path.join(author_stats.cache, "orgs.json")
+        self.cache = {}
+        self.changed = False
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get("key") == resolver.key:
+                self.cache = data["commits"]
+
+    def __getitem__(self, commit):
+        sha1 = self.author_stats._sha1(commit)
+        name = self.author_stats.name
+
+        # resolving keeps the total, so it fingerprints the author stats
+        cached = self.cache.get(sha1)
+        record = cache_manifest().get(name, sha1)
+        if cached is not None and record is not None:
+            if sum(cached.values()) == record["lines"]:
+                return cached
+
+        orgs = self.resolver.organizations(self.author_stats[commit])
+        if (name, sha1) in cache_manifest():
+            self.cache[sha1] = orgs
+            self.changed = True
+        elif self.cache.pop(sha1, None) is not None:
+            self.changed = True  # incomplete; resolve it again next time
+        return orgs
+
+    def save(self):
+        if not self.changed:
+            return
+
+        temp_name = temp_path(self.path)
+        with open(temp_name, "w") as temp:
+            json.dump({"key": self.resolver.key, "commits": self.cache}, temp)
+        os.rename(temp_name, self.path)
+        self.changed = False
+
+
+class CountMatrix(object):
+    """Line counts for each contributor at each of a list of commits.
+
+    ``matrix`` is a NumPy array with a row for each name in ``names`` and
+    a column for each commit.  Resolving authors to canonical names sums
+    rows, so it costs one pass over the array instead of a pass over
+    every commit's dict.
+    """
+
+    def __init__(self, names, matrix):
+        self.names = names
+        self.matrix = matrix
+
+    @classmethod
+    def from_counts(cls, counts):
+        """Make a matrix from a list of dicts of counts, one per commit."""
+        import numpy as np
+
+        rows = {}
+        row_index, col_index, values = [], [], []
+        for col, count_dict in enumerate(counts):
+            row_index.extend(rows.setdefault(name, len(rows)) for name in count_dict)
+            col_index.extend([col] * len(count_dict))
+            values.extend(count_dict.values())
 
-    arguments = [
-        (commit, filename, os.path.join(blame_dir, filename, "%s.txt" % commit))
-        for filename in files
-    ]
-    nblames = len(arguments)
+        matrix = np.zeros((len(rows), len(counts)), dtype=np.int64)
+        matrix[row_index, col_index] = values
+        return cls(list(rows), matrix)
 
-    outputs = blame_pool.imap_unordered(git_blame_file, arguments)
-    blame = {}
+    def __len__(self):
+        return self.matrix.shape[1]
 
-    start = time.time()
-    times = []
-    for i, output in enumerate(outputs):
-        now = time.time()
-        times.append(now)
+    def group(self, key):
+        """Sum the rows of names that ``key(name)`` maps to the same name."""
+        groups = {}
+        inverse = [groups.setdefault(key(name), len(groups)) for name in self.names]
+        if not groups:
+            return CountMatrix([], self.matrix)
 
-        est = times[-30:]
-        est_start = est[0] if len(est) > 1 else start
-        rate = len(est) / (now - est_start)
+        import numpy as np
 
-        if not verbose:
-            # write summary here (verbose prints out all git commands)
-            sys.stdout.write(
-                "\r    %s: processed %d/%d blames (%.2f/s)     "
-                % (name, i + 1, nblames, rate)
-            )
-            sys.stdout.flush()
+        # sort rows by group, then sum each run of rows in one call
+        order = np.argsort(inverse, kind="stable")
+        starts = np.searchsorted(np.array(inverse)[order], np.arange(len(groups)))
+        matrix = np.add.reduceat(self.matrix[order], starts, axis=0)
+        return CountMatrix(list(groups), matrix)
 
-        for _, author, line in iter_blame(output):
-            if not any(ig.search(line) for ig in ignore):
-                blame.setdefault(author, 0)
-                blame[author] += 1
-    if not verbose:
-        sys.stdout.write("\n")
-        sys.stdout.flush()
-    return blame
+    def resolve(self, resolver):
+        """Sum authors' rows by canonical name (see ``IdentityResolver``)."""
+        return self.group(resolver.identity)
 
 
-class AuthorStats(object):
-    """Cache of line stats by commit."""
+#: ``datetime.datetime.fromisoformat``, or None before Python 3.7
+_fromisoformat = getattr(datetime.datetime, "fromisoformat", None)
 
-    def __init__(self, name, places):
-        self.name = name
-        self.commits = {}
-        self.places = places
-        self.cache = os.path.join(parts_dir, name)
-        if not os.path.isdir(self.cache):
-            mkdirp(self.cache)
 
-    def _path(self, sha1):
-        return os.path.join(self.cache, "%s.json" % sha1)
+def parse_date(text):
+    """Parse an ISO 8601 date, e.g. from ``git log --format=%cI``.
 
-    def _sha1(self, commit):
-        return git("rev-parse", commit, split=False).strip()
+    ``datetime.fromisoformat()`` is much faster than dateutil, which is
+    only used for forms it does not accept (like ``Z`` before Python 3.11),
+    and on Python 3.6, which does not have it.
+    """
+    if _fromisoformat is not None:
+        try:
+            return _fromisoformat(text)
+        except ValueError:
+            pass
+    return dateutil.parser.parse(text)
 
-    def __contains__(self, commit):
-        sha1 = self._sha1(commit)
-        return sha1 in self.commits or os.path.exists(self._path(sha1))
 
-    def __getitem__(self, commit):
-        """Get author-to-line-mapping for a SHA1 hash"""
-        sha1 = self._sha1(commit)
-        if sha1 in self.commits:
-            return self.commits[sha1]
+def _walk_history(rev):
+    """Walk first-parent history from ``rev`` (which may be a range).
 
-        path = self._path(sha1)
-        if os.path.exists(path):
-            with open(path) as f:
-                stats = json.load(f)
-                self.commits[sha1] = stats
-                return stats
+    Returns a list of ``[commit, date]`` for non-merge commits, newest
+    first, and the first parent of the oldest commit walked.
+    """
+    commits = []
+    base = None
+    for line in git("log", "--first-parent", "--format=%H %P %cI", rev):
+        if not line:
+            continue
+        fields = line.split()
+        parents = fields[1:-1]
+        base = parents[0] if parents else None
+        if len(parents) <= 1:
+            commits.append([fields[0], fields[-1]])
+    return commits, base
 
-        stats = git_blame(sha1, self.places, self.name)
-        temp_name = path + ".tmp"
-        with open(temp_name, "w") as temp:
-            json.dump(stats, temp, indent=True, separators=(",", ": "))
-        os.rename(temp_name, path)
 
-        self.commits[sha1] = stats
-        return stats
+#: (repo, HEAD, history) from the last call to ``commit_history()``
+_history = None
 
 
-class OrgStats(object):
-    def __init__(self, author_stats, authors_to_orgs):
-        self.author_stats = author_stats
-        self.authors_to_orgs = authors_to_orgs
-        self.cache = {}
+def commit_history():
+    """Get a list of (commit, date) on the current branch, newest first.
 
-    def __getitem__(self, commit):
-        if commit not in self.cache:
-            author_stats = self.author_stats[commit]
-            org_stats = {}
-            for author, count in author_stats.items():
-                org = self.authors_to_orgs.get(author, "unknown")
-                if org.startswith("unknown"):
-                    org = "unknown"
-                org_stats[org] = org_stats.setdefault(org, 0) + count
-            self.cache[commit] = org_stats
-        return self.cache[commit]
+    Like ``git log --first-parent --no-merges``, with commit dates.  The
+    log is walked at most once per run, and cached in ``history_file``
+    keyed by the HEAD commit.  If HEAD has moved forward since, only the
+    new commits are walked.
+    """
+    global _history
+    head, _, _ = git_objects().read("HEAD^{commit}")
+    if _history is not None and _history[:2] == (git_repo_dir, head):
+        return _history[2]
+
+    cached = None
+    if history_file and os.path.exists(history_file):
+        with open(history_file) as f:
+            cached = json.load(f)
+
+    if cached and cached["head"] == head:
+        commits = cached["commits"]
+    else:
+        commits = None
+        if cached:
+            try:
+                git_objects().read(cached["head"] + "^{commit}")
+                new, base = _walk_history("%s..%s" % (cached["head"], head))
+                if base == cached["head"]:
+                    commits = new + cached["commits"]
+            except ValueError:
+                pass  # rewritten, or from another repository
+
+        if commits is None:
+            commits, _ = _walk_history(head)
+
+        if history_file:
+            if os.path.dirname(history_file):
+                mkdirp(os.path.dirname(history_file))
+            temp_name = temp_path(history_file)
+            with open(temp_name, "w") as temp:
+                json.dump({"head": head, "commits": commits}, temp)
+            os.rename(temp_name, history_file)
+
+    history = [(commit, parse_date(date)) for commit, date in commits]
+    _history = (git_repo_dir, head, history)
+    return history
 
 
 def linear_history(length=sys.maxsize):
     """Yield tuples of (commit, date) on the current branch, from newest to
     oldest.  Date used is commit date, because it is monotonic."""
-    output = git("log", "--first-parent", "--no-merges", "--format=%H %cI")
-    for i, line in enumerate(output):
+    for i, (commit, date) in enumerate(commit_history()):
         if i >= length:
             break
-        commit, date = re.split(r"\s+", line)
-        yield commit, dateutil.parser.parse(date)
+        yield commit, date
 
 
 def sampled_history(ndates):
@@ -275,12 +1888,7 @@ def sampled_history(ndates):
     always includes the latest commit.
 
     """
-    commits = []
-
-    output = git("log", "--first-parent", "--no-merges", "--format=%H %cI")
-    for i, line in enumerate(output):
-        commit, date = re.split(r"\s+", line)
-        commits.append((commit, dateutil.parser.parse(date)))
+    commits = commit_history()
 
     if len(commits) == 1:
         return commits
@@ -308,18 +1916,162 @@ def sampled_history(ndates):
     return list(reversed(samples))
 
 
-def _build_index(history, stats):
+def commit_churn(places):
+    """Yield (timestamp, lines) for each first-parent commit that changes
+    files matching ``places``, where lines is lines added plus deleted.
+
+    Merges are diffed against their first parent.  Uses only ``git log
+    --numstat``, which is much cheaper than blame.
+    """
+    args = ["log", "--first-parent", "-m", "--no-renames", "--numstat"]
+    args.append("--format=%x00%ct")
+    prefixes = place_prefixes(places)
+    if prefixes:
+        args += ["--"] + prefixes
+
+    matches = {}
+    timestamp, lines = None, 0
+    with git_stream(*args) as output:
+        for line in output:
+            if line.startswith("\0"):
+                if lines:
+                    yield timestamp, lines
+                timestamp, lines = int(line[1:]), 0
+                continue
+            if not line:
+                continue
+
+            added, deleted, path = line.split("\t", 2)
+            if added == "-":
+                continue  # binary file
+            path = unquote_path(path)
+            if path not in matches:
+                matches[path] = any(regex.search(path) for regex in places)
+            if matches[path]:
+                lines += int(added) + int(deleted)
+
+    if lines:
+        yield timestamp, lines
+
+
+def churn_sampled_history(nsamples, places):
+    """Like ``sampled_history()``, but put samples where lines change.
+
+    Samples split the churn in ``places`` into equal shares, so busy
+    periods get more samples than quiet ones.  The first and latest
+    commits are always sampled.  Commits that change a lot at once
+    (e.g. imports) can leave fewer than ``nsamples`` samples.  A single
+    sample is the latest commit.
+    """
+    commits = list(reversed(commit_history()))  # oldest first
+    if nsamples < 2:
+        return commits[-1:]
+    if len(commits) <= nsamples:
+        return list(reversed(commits))
+
+    # churn of each commit, including merges just before it
+    timestamps = [date.timestamp() for _, date in commits]
+    weights = [0] * len(commits)
+    for timestamp, lines in commit_churn(places):
+        i = bisect.bisect_left(timestamps, timestamp)
+        if i < len(weights):
+            weights[i] += lines
+
+    total = sum(weights)
+    if not total:
+        return sampled_history(nsamples)
+
+    step = total / (nsamples - 1)
+    target = step
+    cumulative = 0
+    samples = [0]
+    for i, weight in enumerate(weights):
+        cumulative += weight
+        if cumulative >= target:
+            if i != samples[-1]:
+                samples.append(i)
+            while target <= cumulative:
+                target += step
+
+    if samples[-1] != len(commits) - 1:
+        samples.append(len(commits) - 1)
+
+    return [commits[i] for i in reversed(samples)]
+
+
+def plan_commit(commit, parts, tree):
+    """Work out which files each part needs at a commit.
+
+    Returns the list of all files needed by any of ``parts`` (each listed
+    once), and a dictionary mapping each part's name to its own files.
+    """
+    part_files = {}
+    files = []
+    seen = set()
+    for gs in parts:
+        part_files[gs.name] = files_for_commit(commit, gs.places, tree)
+        for f in part_files[gs.name]:
+            if f not in seen:
+                files.append(f)
+                seen.add(f)
+    return files, part_files
+
+
+class CommitJob(object):
+    """Per-file blame results still outstanding for one commit.
+
+    Once every file has been counted, ``finish()`` sums the per-file
+    counts into each part that matches the file and stores the result.
+    """
+
+    def __init__(self, sha1, parts, files, part_files):
+        self.sha1 = sha1
+        self.parts = parts
+        self.part_files = part_files
+        self.results = {}
+        self.remaining = len(files)
+
+    def add(self, filename, counts):
+        """Record counts for one file; return True if the commit is done.
+
+        ``counts`` is ``None`` if the file could not be blamed.
+        """
+        self.results[filename] = counts
+        self.remaining -= 1
+        return self.remaining == 0
+
+    def finish(self):
+        for gs in self.parts:
+            files = self.part_files[gs.name]
+            stats = sum_counts(
+                self.results[f] for f in files if self.results[f] is not None
+            )
+            skipped = [f for f in files if self.results[f] is None]
+            gs.update(self.sha1, stats, skipped, files=len(files))
+
+
+def author_stats(stats):
+    """Make an ``AuthorStats`` for each part in a name-to-regexes dict."""
     stats_by_name = {}
     for name, places in stats.items():
         regexes = []
         for regex in places:
             regexes.append(re.compile(regex))
         stats_by_name[name] = AuthorStats(name, regexes)
+    return stats_by_name
 
-    todo = set()
+
+def _build_index(history, stats):
+    stats_by_name = author_stats(stats)
+
+    todo = []
+    seen = set()
     for commit, date in history:
+        if commit in seen:
+            continue
+        seen.add(commit)
         if any(commit not in gs for gs in stats_by_name.values()):
-            todo.add(commit)
+            todo.append(commit)
 
     total = len(history)
     remaining = len(todo)
@@ -328,28 +2080,359 @@ def _build_index(history, stats):
     print("==> %d commits already complete." % completed)
     print("==> %d commits remaining to index." % remaining)
 
-    then = time.time()
-    for i, (commit, date) in enumerate(history):
-        if commit not in todo:
-            continue
+    count_cache_stats.clear()
+    del failed_blames[:]
+
+    # Commits are planned a window at a time, as earlier ones finish, so
+    # memory does not grow with the length of the history.  Tasks from
+    # all commits in the window go into one queue, so workers stay busy
+    # until the very end, and a commit's stats are written as soon as its
+    # last file is done.  Each version of a file (path, blob) gets a
+    # single blame task, shared by all the commits waiting for it, and
+    # counts of recently finished files are reused without a task.
+    progress = BlameProgress("blame")
+    progress.commits = len(todo)
+    schedule = BlameSchedule(progress)
+    waiting = {}  # (path, blob) -> jobs waiting for its counts
+    recent = LRUCache(index_recent_files)  # (path, blob) -> counts
+    previous = []  # with --incremental: [sha1, prefixes, blobs] last planned
+    window = threading.Semaphore(index_window)
+    stopped = threading.Event()
+
+    # Pools read tasks in another thread, so planning and handling
+    # results take turns with this lock.
+    lock = threading.Lock()
+    start = time.time()
+
+    def finish(job):
+        job.finish()
+        window.release()
+        progress.commits_done += 1
+        progress.message(
+            "COMPLETED %5d/%d %s in %.2fs"
+            % (progress.commits_done, len(todo), job.sha1, time.time() - start)
+        )
+
+    def plan(commit):
+        parts = [gs for gs in stats_by_name.values() if commit not in gs]
+        sha1 = git_objects().rev_parse(commit)
+        places = [regex for gs in parts for regex in gs.places]
+        prefixes = place_prefixes(places)
+
+        if incremental and previous and previous[1] == prefixes:
+            blobs = dict(previous[2])
+            for path, blob in changed_files(previous[0], sha1, prefixes).items():
+                if blob is None:
+                    blobs.pop(path, None)
+                else:
+                    blobs[path] = blob
+            tree = sorted(blobs.items())
+        else:
+            tree = ls_tree(sha1, prefixes)
+            blobs = dict(tree)
+        if incremental:
+            previous[:] = [sha1, prefixes, blobs]
+        files, part_files = plan_commit(sha1, parts, tree)
+
+        job = CommitJob(sha1, parts, files, part_files)
+        tasks = []
+        for filename in files:
+            key = (filename, blobs[filename])
+            if key in waiting:
+                waiting[key].append(job)
+            elif key in recent:
+                job.add(filename, recent[key])
+            else:
+                waiting[key] = [job]
+                tasks.append((sha1, filename, blobs[filename]))
+
+        if not job.remaining:
+            finish(job)
+        return schedule.add(tasks)
+
+    def planned_tasks():
+        for commit in todo:
+            window.acquire()
+            if stopped.is_set():
+                return
+            with lock:
+                tasks = plan(commit)
+            for task in tasks:
+                yield task
+
+    try:
+        results = run_blames(planned_tasks(), progress, schedule)
+        for filename, blob, counts in results:
+            with lock:
+                recent[filename, blob] = counts
+                for job in waiting.pop((filename, blob)):
+                    if job.add(filename, counts):
+                        finish(job)
+    finally:
+        # let the planning thread finish if we stopped early
+        stopped.set()
+        for _ in range(index_window):
+            window.release()
+
+    if failed_blames:
+        print("==> Warning: %d files could not be blamed:" % len(failed_blames))
+        for filename, commit, reason in failed_blames:
+            print("    %s at %s: %s" % (filename, commit, reason))
+        print("==> They are listed as '%s' in the per-commit JSON." % skipped_key)
+        print("==> Their commits will be indexed again on the next run.")
+
+    lookups = sum(count_cache_stats.values())
+    if lookups:
+        print(
+            "==> Blame cache: %d hits, %d misses (%.1f%% hit rate)"
+            % (
+                count_cache_stats["hits"],
+                count_cache_stats["misses"],
+                100.0 * count_cache_stats["hits"] / lookups,
+            )
+        )
+
+    trace(
+        "blame_cache",
+        hits=count_cache_stats["hits"],
+        misses=count_cache_stats["misses"],
+    )
+    trace(
+        "git_objects",
+        reads=git_objects().reads,
+        seconds=git_objects().read_seconds,
+    )
+    return stats_by_name
+
+
+def unquote_path(path):
+    """Undo git's C-style quoting of unusual paths in diff headers."""
+    if not path.startswith('"'):
+        return path
+    path = path[1:-1].encode("latin-1").decode("unicode_escape")
+    return path.encode("latin-1").decode("utf-8", "replace")
+
+
+class LineReplay(object):
+    """Tracks who wrote each line of every file by replaying diffs.
+
+    Each file is a list with one entry per line: the author of the line,
+    or ``None`` if the line matches an ``ignore`` pattern.  Running
+    per-author totals and file counts are kept for each part, so a
+    snapshot of a part costs one dictionary copy.
+    """
+
+    def __init__(self, parts):
+        self.parts = parts  # list of AuthorStats
+        self.files = {}
+        self.totals = dict((gs.name, collections.Counter()) for gs in parts)
+        self.nfiles = collections.Counter()
+        self.matches = {}
+
+    def _parts_for(self, path):
+        if path not in self.matches:
+            self.matches[path] = [
+                gs.name
+                for gs in self.parts
+                if any(regex.search(path) for regex in gs.places)
+            ]
+        return self.matches[path]
+
+    def _count(self, path, authors, sign):
+        for name in self._parts_for(path):
+            totals = self.totals[name]
+            for author in authors:
+                if author is not None:
+                    totals[author] += sign
+
+    def _count_file(self, path, sign):
+        for name in self._parts_for(path):
+            self.nfiles[name] += sign
+
+    def rename(self, old, new):
+        lines = self.files.pop(old, [])
+        self._count(old, lines, -1)
+        self.files[new] = lines
+        self._count(new, lines, 1)
+        if lines:
+            self._count_file(old, -1)
+            self._count_file(new, 1)
+
+    def apply_hunk(self, path, old_start, old_len, author, added):
+        """Replace ``old_len`` lines at ``old_start`` with ``added`` lines.
+
+        Positions are as in a ``git diff -U0`` hunk header, already
+        shifted by the effect of earlier hunks in the same file.
+        """
+        lines = self.files.setdefault(path, [])
+        existed = bool(lines)
+        start = old_start if old_len == 0 else old_start - 1
+        removed = lines[start : start + old_len]
+        new = [None if is_ignored(text) else author for text in added]
+        lines[start : start + old_len] = new
+
+        self._count(path, removed, -1)
+        self._count(path, new, 1)
+        if existed != bool(lines):
+            self._count_file(path, 1 if lines else -1)
+
+    def snapshot(self, name):
+        """Get the current author-to-line-count mapping for a part."""
+        return dict((a, n) for a, n in self.totals[name].items() if n > 0)
+
+    def file_count(self, name):
+        """Get the number of non-empty files currently in a part."""
+        return self.nfiles[name]
+
+    def run(self, wanted):
+        """Replay first-parent history, yielding commits in ``wanted``.
+
+        Walks from the root commit forward, and yields each commit in
+        ``wanted`` once its diff has been applied, so ``snapshot()``
+        reflects the tree at that commit.
+        """
+        log_args = [
+            "log",
+            "--first-parent",
+            "-m",
+            "--reverse",
+            "-p",
+            "--text",
+            "-U0",
+            "-w",
+            "-M",
+            "--no-color",
+            "--no-ext-diff",
+            "--format=%x00%H%x00%aN",
+        ]
+
+        commit = author = None
+        old_path = new_path = None
+        added = []
+        hunk = None
+        offset = 0
+
+        def flush_hunk():
+            if hunk is not None:
+                old_start, old_len = hunk
+                self.apply_hunk(new_path, old_start + offset, old_len, author, added)
+
+        with git_stream(*log_args) as lines:
+            for line in lines:
+                if line.startswith("\0"):
+                    flush_hunk()
+                    hunk = None
+                    if commit in wanted:
+                        yield commit
+                    _, commit, author = line.split("\0", 2)
+
+                elif hunk is not None and line.startswith("+"):
+                    added.append(line[1:])
+
+                elif hunk is not None and line.startswith(("-", "\\")):
+                    pass  # removed lines are dropped by position
+
+                elif line.startswith("@@ "):
+                    flush_hunk()
+                    if hunk is not None:
+                        offset += len(added) - hunk[1]
+                    old, _ = line[3:].split(" ", 2)[:2]
+                    start, _, length = old[1:].partition(",")
+                    hunk = (int(start), int(length) if length else 1)
+                    added = []
+
+                elif line.startswith("diff --git "):
+                    flush_hunk()
+                    hunk = None
+                    old_path = new_path = None
+                    offset = 0
+
+                elif line.startswith("rename from "):
+                    old_path = unquote_path(line[12:])
+                elif line.startswith("rename to "):
+                    new_path = unquote_path(line[10:])
+                    self.rename(old_path, new_path)
+
+                # deleted files keep an empty line list, added files start
+                # from one, so /dev/null sides can just be skipped
+                elif line.startswith("--- "):
+                    if line != "--- /dev/null":
+                        old_path = unquote_path(line[4:].rstrip("\t"))[2:]
+                elif line.startswith("+++ "):
+                    if line == "+++ /dev/null":
+                        new_path = old_path
+                    else:
+                        new_path = unquote_path(line[4:].rstrip("\t"))[2:]
+
+            flush_hunk()
+            if commit in wanted:
+                yield commit
+
+
+def replay_index(history, stats):
+    """Build the index with one forward pass over history.
+
+    This is the ``replay`` engine: instead of running ``git blame`` at
+    every sampled commit, it replays each first-parent diff and takes a
+    snapshot of line ownership at each sampled commit.  Results are
+    stored in the same per-commit JSON files as blame results.
+
+    Attribution is close to, but not exactly, what ``git blame -w -M -C``
+    gives: lines copied between files, and lines merged in from side
+    branches, are credited to the commit that copied or merged them.
+    """
+    stats_by_name = author_stats(stats)
+
+    todo = set()
+    for commit, date in history:
+        if any(commit not in gs for gs in stats_by_name.values()):
+            todo.add(git_objects().rev_parse(commit))
+
+    print("==> %d commits already complete." % (len(history) - len(todo)))
+    print("==> %d commits remaining to index." % len(todo))
+    if not todo:
+        return stats_by_name
 
-        print("STARTED %5d/%d %s" % (i + 1, len(history), commit))
+    replay = LineReplay(list(stats_by_name.values()))
+    start = time.time()
+    done = 0
+    for commit in replay.run(todo):
         for gs in stats_by_name.values():
-            gs[commit]
+            if commit not in gs:
+                gs.update(
+                    commit, replay.snapshot(gs.name), files=replay.file_count(gs.name)
+                )
+        done += 1
+        print(
+            "COMPLETED %5d/%d %s in %.2fs"
+            % (done, len(todo), commit, time.time() - start)
+        )
 
-        now = time.time()
-        delta = now - then
-        print("    COMPLETED in %.2fs" % delta)
-        then = now
+    if done < len(todo):
+        print(
+            "==> Warning: %d commits are not on the first-parent history of HEAD."
+            % (len(todo) - done)
+        )
 
     return stats_by_name
 
 
 def build_index(history, stats):
+    if engine == "replay":
+        return replay_index(history, stats)
+
     global blame_pool
 
+    # open the store here, so pool workers don't each pack loose files
+    blame_store()
+
     if blame_pool is None:
-        blame_pool = multiprocessing.Pool(blame_jobs)
+        if executor == "thread":
+            blame_pool = multiprocessing.pool.ThreadPool(blame_jobs)
+        elif executor == "asyncio":
+            blame_pool = AsyncBlamePool(blame_jobs)
+        else:
+            blame_pool = multiprocessing.Pool(blame_jobs)
 
     try:
         return _build_index(history, stats)
@@ -358,59 +2441,82 @@ def build_index(history, stats):
         blame_pool = None
 
 
+def pyplot():
+    """Import ``matplotlib.pyplot`` for plotting, and return it.
+
+    matplotlib is slow to import, so it is only loaded when a plot is
+    made, and never by ``--index`` runs or blame workers.  Plots are only
+    saved to files, so this uses the non-interactive Agg backend.
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot
+
+    return matplotlib.pyplot
+
+
 def plot(filename, title, counts, dates, top_n=20):
     """Makes a stacked line plot of contributions over time.
 
     Plot will be stored in PDF named ``filename``, with the given
     ``title``, using data in ``counts`` and ``dates``.
 
-    ``counts`` is a list of dictionaries, each mapping the contributor
-    name (author, organization, etc.) to line count for a
-    commit. ``dates`` is a list of dates, for the commits. The two lists
-    should be the same length.
+    ``counts`` is a ``CountMatrix``, or a list of dictionaries, each
+    mapping the contributor name (author, organization, etc.) to line
+    count for a commit. ``dates`` is a list of dates, for the commits.
+    There should be a date for each commit in ``counts``.
 
     The stacked plots will explicitly show data for the top N
     contributors.  N defaults to 20.
     """
     print("==> Creating plot: %s" % filename)
+    start = time.time()
+    plt = pyplot()
+    import matplotlib.cm
+    import matplotlib.colors
+    import numpy as np
+
+    if not isinstance(counts, CountMatrix):
+        counts = CountMatrix.from_counts(counts)
+
     # Sort data ascending by date.
-    sorted_list = sorted(zip(dates, counts))
-    dates, counts = zip(*sorted_list)
+    order = sorted(range(len(dates)), key=lambda i: dates[i])
+    dates = [dates[i] for i in order]
+    matrix = counts.matrix[:, order]
+    names = counts.names
 
     # Get sorted lists of top contributors (by line) from the last commit.
-    contributors = sorted(counts[-1].keys(), key=lambda c: counts[-1][c])
+    last = matrix[:, -1]
+    present = np.flatnonzero(last)
+    by_count = np.lexsort((np.array(names, dtype=object)[present], last[present]))
+    contributors = present[by_count].tolist()
     with open(filename + ".json", "w") as all_counts:
         json.dump(
-            [(c, counts[-1][c]) for c in reversed(contributors)],
+            [(names[i], int(last[i])) for i in reversed(contributors)],
             all_counts,
             indent=2,
             separators=(",", ": "),
         )
 
     top_contributors = contributors[-top_n:]
-    if "unknown" in top_contributors:
-        top_contributors = contributors[-top_n - 1 :]
-        top_contributors.remove("unknown")
+    if "unknown" in counts.names:
+        unknown = counts.names.index("unknown")
+        if unknown in top_contributors:
+            top_contributors = contributors[-top_n - 1 :]
+            top_contributors.remove(unknown)
 
-    labels = top_contributors
+    labels = ["Other"] + [names[i] for i in top_contributors]
 
-    # List of series, one for each top contributor. Each element is a
-    # count for a commit.
-    series = [[cdict.get(c, 0) for cdict in counts] for c in top_contributors]
-
-    # List of summed line counts from "other", non-top contributors
-    other = [
-        sum(count for c, count in cdict.items() if c not in top_contributors)
-        for cdict in counts
-    ]
-    if other:
-        series.insert(0, other)
-        labels = ["Other"] + labels
+    # One row for each top contributor, after the summed line counts from
+    # "other", non-top contributors. Each column is a commit.
+    top = matrix[top_contributors]
+    series = np.vstack([matrix.sum(axis=0) - top.sum(axis=0), top])
 
     # Use a nice color scheme.
     cm = plt.get_cmap("Paired")
     c_norm = matplotlib.colors.Normalize(vmin=0, vmax=len(series) - 1)
-    scalar_map = cmx.ScalarMappable(norm=c_norm, cmap=cm)
+    scalar_map = matplotlib.cm.ScalarMappable(norm=c_norm, cmap=cm)
 
     # Try to add contrast by shuffling the initially smooth-ish gradient.
     nc = len(series)
@@ -418,7 +2524,7 @@ def plot(filename, title, counts, dates, top_n=20):
     colors.reverse()
     colors = colors[::3] + colors[1::3] + colors[2::3]
 
-    plt.figure(figsize=(8, 4), dpi=320)
+    figure = plt.figure(figsize=(8, 4), dpi=320)
     plt.title(title, fontname="Arial")
 
     # Do the plot
@@ -433,30 +2539,320 @@ def plot(filename, title, counts, dates, top_n=20):
 
     plt.tight_layout()
     plt.savefig(filename)
+    plt.close(figure)
+    trace(
+        "plot",
+        file=filename,
+        series=len(series),
+        samples=len(dates),
+        seconds=time.time() - start,
+    )
+
+
+def plot_hash(filename, title, counts, dates, top_n):
+    """Hash of everything that goes into a plot, including its format."""
+    import numpy as np
+
+    sha1 = hashlib.sha1()
+    header = [os.path.splitext(filename)[1], title, top_n, counts.names]
+    header.append([date.isoformat() for date in dates])
+    sha1.update(json.dumps(header).encode("utf-8"))
+    sha1.update(np.ascontiguousarray(counts.matrix, dtype=np.int64).tobytes())
+    return sha1.hexdigest()
+
+
+def plot_task(chart):
+    """Render one chart in a pool worker; returns its filename."""
+    plot(*chart)
+    return chart[0]
+
+
+def render_plots(charts, jobs=1):
+    """Render plots, in parallel if ``jobs`` > 1.
+
+    ``charts`` is a list of ``plot()`` arguments: (filename, title,
+    counts, dates, top_n), with ``counts`` a ``CountMatrix``.  Each one is
+    rendered in its own worker process, with its figure closed after it
+    is saved.  Charts whose data, title, and format have not changed
+    since they were last rendered are skipped if their files still
+    exist.  Returns the number of charts rendered.
+    """
+    hashes = {}
+    if os.path.exists(plots_file):
+        with open(plots_file) as f:
+            hashes = json.load(f)
+
+    todo = []
+    digests = {}
+    for chart in charts:
+        filename = chart[0]
+        digests[filename] = plot_hash(*chart)
+        up_to_date = hashes.get(filename) == digests[filename] and all(
+            os.path.exists(f) for f in (filename, filename + ".json")
+        )
+        if up_to_date:
+            print("==> Plot is up to date: %s" % filename)
+        else:
+            todo.append(chart)
+
+    pool = None
+    if jobs > 1 and len(todo) > 1:
+        # forked workers start with the charts and modules already loaded,
+        # instead of importing contrib and numpy again to unpickle them
+        context = multiprocessing.get_context()
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        pool = context.Pool(min(jobs, len(todo)))
+        rendered = pool.imap_unordered(plot_task, todo)
+    else:
+        rendered = map(plot_task, todo)
+
+    try:
+        for filename in rendered:
+            hashes[filename] = digests[filename]
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+        mkdirp(os.path.dirname(plots_file))
+        temp_name = temp_path(plots_file)
+        with open(temp_name, "w") as temp:
+            json.dump(hashes, temp, indent=True, separators=(",", ": "))
+        os.rename(temp_name, plots_file)
+
+    return len(todo)
+
+
+def org_map_hash(authors_to_orgs):
+    return hashlib.sha1(
+        json.dumps(sorted(authors_to_orgs.items())).encode("utf-8")
+    ).hexdigest()
 
 
 def update_org_map(filename, authors_to_orgs):
-    lines = git("log", "--no-merges", "--pretty=format:%aN|%ae")
+    """Add authors from the repository's history to an orgmap file.
+
+    The last commit scanned is recorded in ``org_map_scan_file``, along
+    with a hash of the orgmap it produced.  If ``authors_to_orgs`` is still
+    that orgmap, only commits since then are scanned; if it was edited,
+    the whole history is scanned again.  ``filename`` is only rewritten if
+    authors were added.  Returns a sorted list of the new authors.
+    """
+    head = git_objects().rev_parse("HEAD")
+    rev = head
+
+    if os.path.exists(org_map_scan_file):
+        with open(org_map_scan_file) as f:
+            scan = json.load(f)
+        if scan["orgmap"] == org_map_hash(authors_to_orgs) and os.path.exists(filename):
+            try:
+                rev = "%s..%s" % (git_objects().rev_parse(scan["commit"]), head)
+            except ValueError:
+                pass  # no longer in the repository; scan everything
+
+    seen = set()
+    new_authors = []
+    with git_stream("log", "--no-merges", "--format=%aN|%ae", rev) as lines:
+        for line in lines:
+            name, email = line.rsplit("|", 1)
+            if name in seen:
+                continue
+            seen.add(name)
 
-    new_authors = 0
-    for line in lines:
-        name, email = line.split("|")
-        if name not in authors_to_orgs or authors_to_orgs[name] == "unknown":
-            authors_to_orgs[name] = "unknown <%s>" % email
-            new_authors += 1
+            if name not in authors_to_orgs or authors_to_orgs[name] == "unknown":
+                authors_to_orgs[name] = "unknown <%s>" % email
+                new_authors.append(name)
+    new_authors.sort()
 
     if new_authors:
-        temp_name = "%s.tmp.%d" % (filename, os.getpid())
+        temp_name = temp_path(filename)
         with open(temp_name, "w") as temp:
             sorted_dict = collections.OrderedDict(sorted(authors_to_orgs.items()))
             json.dump(sorted_dict, temp, indent=2, separators=(",", ": "))
             temp.write("\n")  # add back trailing newline
         os.rename(temp_name, filename)
 
-        print("==> Added %d new authors to '%s'" % (new_authors, filename))
+        print("==> Added %d new authors to '%s':" % (len(new_authors), filename))
+        for name in new_authors:
+            print("    %s %s" % (name, authors_to_orgs[name][len("unknown ") :]))
     else:
         print("==> No new authors.")
 
+    mkdirp(os.path.dirname(org_map_scan_file))
+    temp_name = temp_path(org_map_scan_file)
+    with open(temp_name, "w") as temp:
+        json.dump({"commit": head, "orgmap": org_map_hash(authors_to_orgs)}, temp)
+    os.rename(temp_name, org_map_scan_file)
+
+    return new_authors
+
+
+def shard_type(value):
+    """argparse type for ``--shard I/N``; returns an (I, N) tuple."""
+    match = re.match(r"^(\d+)/(\d+)$", value)
+    if not match:
+        raise argparse.ArgumentTypeError("shard must look like I/N, e.g. 2/8")
+    i, n = int(match.group(1)), int(match.group(2))
+    if not 1 <= i <= n:
+        raise argparse.ArgumentTypeError("shard I/N needs 1 <= I <= N: %s" % value)
+    return i, n
+
+
+def size_type(value):
+    """argparse type for sizes like 500M or 2G."""
+    match = re.match(r"^(\d+(?:\.\d+)?)([KMG]?)B?$", value.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError("invalid size: '%s'" % value)
+    number, unit = match.groups()
+    return int(float(number) * {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30}[unit])
+
+
+def shard_history(history, i, n):
+    """Get the share of ``history`` that shard ``i`` of ``n`` should index.
+
+    Commits are dealt out round-robin, so every shard gets a mix of old
+    (cheap) and new (expensive) commits.
+    """
+    return history[i - 1 :: n]
+
+
+def merge_cache(sources):
+    """Merge per-commit part stats from other ``line-data`` directories.
+
+    Each source is either a ``line-data`` directory or its ``parts``
+    subdirectory, e.g. from ``contrib --shard`` runs on other machines,
+    and must have some stats in it.  All sources are checked first: if any
+    commit has different stats in two places, nothing is merged and
+    contrib exits with an error.  Stats with files that could not be
+    blamed don't conflict; complete stats for the commit replace them.
+    Returns the number of files copied.
+
+    Manifest records for copied commits come from the source's manifest
+    if it has one; otherwise commit dates are looked up in git.
+    """
+    to_copy = {}  # destination -> (source path, stats, manifest record)
+    conflicts = []
+
+    for source in sources:
+        if os.path.isdir(os.path.join(source, "parts")):
+            source = os.path.join(source, "parts")
+        if not os.path.isdir(source):
+            die("no such cache directory: '%s'" % source)
+
+        records = {}
+        manifest_path = os.path.join(source, "manifest.jsonl")
+        if os.path.exists(manifest_path):
+            records = CacheManifest(manifest_path).entries
+
+        found = 0
+        for part in sorted(os.listdir(source)):
+            part_dir = os.path.join(source, part)
+            if not os.path.isdir(part_dir):
+                continue
+
+            for filename in sorted(os.listdir(part_dir)):
+                if not re.match(r"^[0-9a-f]{40}\.json$", filename):
+                    continue
+                path = os.path.join(part_dir, filename)
+                with open(path) as f:
+                    stats = json.load(f)
+                found += 1
+
+                dest = os.path.join(parts_dir, part, filename)
+                record = records.get((part, filename[:40]))
+                if dest in to_copy:
+                    other, existing, _ = to_copy[dest]
+                elif os.path.exists(dest):
+                    other = dest
+                    with open(dest) as f:
+                        existing = json.load(f)
+                else:
+                    to_copy[dest] = (path, stats, record)
+                    continue
+
+                if existing == stats or skipped_key in stats:
+                    continue  # keep what we have
+                elif skipped_key in existing:
+                    to_copy[dest] = (path, stats, record)
+                else:
+                    conflicts.append((path, other))
+
+        if not found:
+            die("no cached commit stats in '%s'" % source)
+
+    if conflicts:
+        for path, other in conflicts[:10]:
+            sys.stderr.write("    %s conflicts with %s\n" % (path, other))
+        if len(conflicts) > 10:
+            sys.stderr.write("    ... and %d more\n" % (len(conflicts) - 10))
+        die("%d conflicting commits; nothing was merged" % len(conflicts))
+
+    manifest = cache_manifest()
+    copied = 0
+    for dest, (path, stats, record) in sorted(to_copy.items()):
+        mkdirp(os.path.dirname(dest))
+        temp_name = "%s.tmp.%d" % (dest, os.getpid())
+        with open(temp_name, "w") as temp:
+            json.dump(stats, temp, indent=True, separators=(",", ": "))
+        os.rename(temp_name, dest)
+        copied += 1
+
+        if skipped_key in stats:
+            continue  # incomplete; it will be indexed again
+        elif record is None:
+            part, filename = dest.split(os.sep)[-2:]
+            commit = filename[:40]
+            try:
+                date = git_objects().commit_date(commit)
+            except ValueError:
+                continue  # not in this repository; never in its history
+            manifest.add(part, commit, date, None, sum(stats.values()))
+        else:
+            manifest.add_record(record)
+
+    print("==> Merged %d cached commit stats into '%s'." % (copied, parts_dir))
+    return copied
+
+
+def collect_garbage(budget):
+    """Shrink the blame store to ``budget`` bytes if it is not ``None``.
+
+    Opening the store also packs loose cache files from older versions
+    (see ``blame_store()``).
+    """
+    store = blame_store()
+    evicted, freed = store.gc(sys.maxsize if budget is None else budget)
+    if evicted:
+        print(
+            "==> Evicted %d least recently used blame entries (%s)."
+            % (evicted, format_size(freed))
+        )
+
+
+def print_cache_stats():
+    """Print what is in the blame store and the per-commit stats cache."""
+    store = blame_store()
+    stats = store.stats()
+
+    print(
+        "==> Blame store '%s': %s on disk"
+        % (blame_store_path, format_size(store.disk_size()))
+    )
+    for table in store.tables:
+        print(
+            "    %-8s %8d entries %8s packed %8s raw"
+            % (
+                table,
+                stats[table]["entries"],
+                format_size(stats[table]["packed"]),
+                format_size(stats[table]["raw"]),
+            )
+        )
+
+    commits = collections.Counter(part for part, _ in cache_manifest().entries)
+    for part in sorted(commits):
+        print("    %-8s %8d cached commits" % (part, commits[part]))
+
 
 def create_parser():
     parser = argparse.ArgumentParser()
@@ -497,6 +2893,14 @@ def create_parser():
         default=50,
         help="number of commits to sample for the chart (0 for all commits)",
     )
+    parser.add_argument(
+        "--sampling",
+        action="store",
+        choices=("time", "churn"),
+        default="time",
+        help="space samples evenly in time, or by lines changed in the parts "
+        "(default time)",
+    )
     parser.add_argument(
         "--fuzz",
         action="store",
@@ -510,7 +2914,59 @@ def create_parser():
         action="store",
         type=int,
         default=multiprocessing.cpu_count(),
-        help="number of concurrent blame jobs (default #cpus)",
+        help="number of concurrent blame and plot jobs (default #cpus)",
+    )
+    parser.add_argument(
+        "--executor",
+        action="store",
+        choices=("process", "thread", "asyncio"),
+        default="process",
+        help="run blame jobs in a process pool, a thread pool, or as asyncio "
+        "subprocesses (default process)",
+    )
+    parser.add_argument(
+        "--timeout",
+        action="store",
+        type=float,
+        default=None,
+        help="with --executor asyncio, seconds before a blame is killed",
+    )
+    parser.add_argument(
+        "--retries",
+        action="store",
+        type=int,
+        default=None,
+        help="with --executor asyncio, times to retry a failed blame (default 2)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        default=False,
+        help="list each sampled commit's files by diffing it against the "
+        "previous one, instead of reading its whole tree",
+    )
+    parser.add_argument(
+        "--engine",
+        action="store",
+        choices=("blame", "replay"),
+        default="blame",
+        help="run git blame at each sample, or replay first-parent diffs once "
+        "(default blame)",
+    )
+    parser.add_argument(
+        "--keep-blame",
+        action="store_true",
+        default=False,
+        help="keep raw git blame output in the blame store (uses much more disk)",
+    )
+    parser.add_argument(
+        "--cache-budget",
+        action="store",
+        type=size_type,
+        default=None,
+        metavar="SIZE",
+        help="after indexing, evict least recently used blame data until the "
+        "blame store fits in SIZE (e.g. 500M or 2G)",
     )
     parser.add_argument(
         "-u",
@@ -526,96 +2982,179 @@ def create_parser():
         default="pdf",
         help="format for images (default pdf)",
     )
+    parser.add_argument(
+        "--shard",
+        action="store",
+        type=shard_type,
+        default=None,
+        metavar="I/N",
+        help="only index shard I of N of the sampled commits, and do not plot",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store",
+        default=None,
+        metavar="FILE",
+        help="write timings of git commands, blames, and plots to FILE as JSON lines",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store",
+        default=None,
+        metavar="FILE",
+        help="profile the main process with cProfile, save stats to FILE, "
+        "and print the top functions",
+    )
+
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+    merge_parser = subparsers.add_parser(
+        "merge-cache",
+        help="merge line-data from several shards into ./line-data, then plot",
+    )
+    merge_parser.add_argument(
+        "caches",
+        nargs="+",
+        metavar="DIR",
+        help="line-data (or line-data/parts) directory from a shard",
+    )
+    cache_parser = subparsers.add_parser(
+        "cache", help="show or shrink cached blame data in ./line-data"
+    )
+    cache_parser.add_argument(
+        "action",
+        choices=("stats", "gc"),
+        help="'stats' to show what is cached, 'gc' to pack and evict",
+    )
+    cache_parser.add_argument(
+        "--budget",
+        action="store",
+        type=size_type,
+        default=None,
+        metavar="SIZE",
+        help="with gc, evict least recently used blame data beyond SIZE",
+    )
     return parser
 
 
-def merge(count_dict, merge_list):
+def merge_map(merge_list):
+    """Map each user in ``merge_list`` to the name its counts go under.
+
+    ``merge_list`` is a list of lists of users, and each list is merged
+    into its first user, in order.  A user merged by an earlier list
+    follows its counts if a later list merges them again.
+    """
+    mapping = {}
     for user_list in merge_list:
-        total = 0
-        present = False
+        target = user_list[0]
+        members = set(user_list)
+        for user, merged_into in mapping.items():
+            if merged_into in members:
+                mapping[user] = target
         for user in user_list:
-            if user in count_dict:
-                present = True
-                total += count_dict[user]
-                del count_dict[user]
-        if present:
-            count_dict[user_list[0]] = total
+            mapping.setdefault(user, target)
+    return mapping
 
 
 def fuzz_history(history, fuzz, parts):
     """Find commits that are close to the ones we sampled, so that we do not have to
-    compute blame if we have something nearby."""
-    # usually all parts have same cached commits -- just assume that here. Worst that
-    # happens is we have to blame more if the commit exists in multiple sections
-    part = list(parts)[0]
-    parts_cache = os.path.join(parts_dir, part)
-
-    cached = []
-    for filename in os.listdir(parts_cache):
-        match = re.match(r"([0-9a-f]{40})\.json", filename)
-        if match:
-            commit = match.group(1)
-            date = git("show", "-s", "--format=%ci", commit)[0].strip()
-            cached.append((commit, dateutil.parser.parse(date)))
-
-    # sort by date
-    cached.sort(key=lambda x: x[1])
-
-    # lists of just the cached commits and cached dates
-    commits, dates = zip(*cached)
-
-    # average time bt/w two samples
-    total = dates[1] - dates[0]
-    for i in range(1, len(dates) - 1):
-        total += dates[i + 1] - dates[i]
-    avg_window = total / (len(dates) - 1)
-    print(avg_window)
+    compute blame if we have something nearby.
+
+    A sample is replaced by the nearest commit that is already cached for every
+    part, if it is within ``fuzz`` percent of the average time between cached
+    commits.  Cached commits come from the cache manifest, so this runs no git
+    commands.
+    """
+    manifest = cache_manifest()
+    candidates = None
+    for part in parts:
+        cached = set(manifest.commits(part))
+        candidates = cached if candidates is None else candidates & cached
+
+    # need two cached commits to know how far apart they usually are
+    if not candidates or len(candidates) < 2:
+        return history
+
+    # date-sorted index of cached commits
+    cached = sorted(candidates, key=lambda x: x[1])
+    commits = [commit for commit, _ in cached]
+    dates = [date for _, date in cached]
+    cached_commits = set(commits)
+
+    avg_window = (dates[-1] - dates[0]) / (len(dates) - 1)
     acceptable = fuzz / 100.0 * avg_window
 
     fuzzed = []
-    for h, (commit, date) in enumerate(history):
-        hi = bisect.bisect_left(dates, date)
-        lo = hi - 1
-
-        lo_delta = None
-        if lo > 0 and lo < len(cached):
-            if commits[lo] == commit:
-                fuzzed.append((commit, date))
-                continue
-            lo_delta = date - dates[lo]
-
-        hi_delta = None
-        if hi > 0 and hi < len(cached):
-            hi_delta = dates[hi] - date
-
-        if not lo_delta and not hi_delta:
+    saved = 0
+    for commit, date in history:
+        if commit in cached_commits:
             fuzzed.append((commit, date))
             continue
 
-        if not lo_delta:
-            delta, i = hi_delta, hi
-        elif not hi_delta:
-            delta, i = lo_delta, lo
-        else:
-            delta, i = min(((hi_delta, hi), (lo_delta, lo)))
+        # nearest cached commits before and after the sample
+        hi = bisect.bisect_left(dates, date)
+        neighbors = [i for i in (hi - 1, hi) if 0 <= i < len(dates)]
+        i = min(neighbors, key=lambda i: abs(dates[i] - date))
 
-        if delta <= acceptable:
+        if abs(dates[i] - date) <= acceptable:
             fuzzed.append((commits[i], dates[i]))
+            saved += 1
         else:
             fuzzed.append((commit, date))
 
+    if saved:
+        print(
+            "==> Fuzzing replaced %d of %d samples with nearby cached commits."
+            % (saved, len(history))
+        )
     return fuzzed
 
 
 def main():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    if not args.profile:
+        run(args)
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(run, args)
+    finally:
+        profiler.dump_stats(args.profile)
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        stats.sort_stats("cumulative").print_stats(25)
+        sys.stderr.write("==> Saved profile to '%s'.\n" % args.profile)
+
+
+def run(args):
+    """Run contrib with parsed command line arguments."""
     global verbose
+    global keep_blame
+    global engine
+    global incremental
+    global executor
+    global blame_timeout
+    global blame_retries
     global blame_jobs
     global git_repo_dir
+    global trace_file
 
-    multiprocessing.set_start_method("fork")
+    # start a new trace for each run
+    if args.trace:
+        with open(args.trace, "w"):
+            pass
+        trace_file = os.path.abspath(args.trace)
 
-    parser = create_parser()
-    args = parser.parse_args()
+    # worker processes rely on inheriting module state
+    if args.executor == "process":
+        multiprocessing.set_start_method("fork")
+
+    # only asyncio blames can be timed out and retried
+    if args.executor != "asyncio":
+        for option in ("timeout", "retries"):
+            if getattr(args, option) is not None:
+                die("--%s requires --executor asyncio" % option)
 
     # read config out of git root
     if not os.path.exists(args.file):
@@ -623,12 +3162,33 @@ def main():
 
     config = contrib.config.ContribConfig(args.file)
     verbose = args.verbose
+    keep_blame = args.keep_blame
+    engine = args.engine
+    incremental = args.incremental
+    executor = args.executor
+    blame_timeout = args.timeout
+    if args.retries is not None:
+        blame_retries = args.retries
     blame_jobs = args.jobs
     git_repo_dir = config.repo
 
     if not os.path.exists(os.path.join(config.repo, ".git")):
         die("not a git repo: '%s'" % config.repo)
 
+    # inspect or shrink the cache, and do nothing else
+    if args.command == "cache":
+        if args.action == "gc":
+            budget = args.budget
+            if budget is None:
+                budget = args.cache_budget
+            collect_garbage(budget)
+        print_cache_stats()
+        return
+
+    # combine caches from sharded runs, then go on to plot
+    if args.command == "merge-cache":
+        merge_cache(args.caches)
+
     # update mapping from authors to orgs
     if args.update_org_map:
         filename = config.orgmap_file
@@ -648,42 +3208,74 @@ def main():
         return
 
     # get the list of commits we're going to plot
-    if args.samples == 0:
-        history = list(linear_history())
-    else:
-        history = list(sampled_history(args.samples))
-        if args.fuzz:
-            history = fuzz_history(history, args.fuzz, config.parts)
+    with traced("phase", name="history"):
+        if args.samples == 0:
+            history = list(linear_history())
+        else:
+            if args.sampling == "churn":
+                places = [
+                    re.compile(regex)
+                    for regexes in config.parts.values()
+                    for regex in regexes
+                ]
+                history = churn_sampled_history(args.samples, places)
+            else:
+                history = list(sampled_history(args.samples))
+            if args.fuzz:
+                history = fuzz_history(history, args.fuzz, config.parts)
+
+    # only index this node's share of the commits
+    if args.shard:
+        i, n = args.shard
+        with traced("phase", name="index"):
+            build_index(shard_history(history, i, n), config.parts)
+        if args.cache_budget is not None:
+            collect_garbage(args.cache_budget)
+        print("==> Indexed shard %d/%d." % (i, n))
+        print("==> Combine shards with 'contrib merge-cache DIR...' when done.")
+        return
 
     # build index
-    index = build_index(history, config.parts)
+    with traced("phase", name="index"):
+        index = build_index(history, config.parts)
+    if args.cache_budget is not None:
+        collect_garbage(args.cache_budget)
 
     # if --index, just return after building
     if args.index:
         return
 
     # now do plots by author and by organization
-    for part in config.parts:
-        for by in ["author", "organization"]:
-            cur_index = index
-            if by == "organization":
-                if not config.orgmap:
-                    print("==> No orgmap specified. Skipping.")
-                    continue
-                cur_index = {
-                    name: OrgStats(s, config.orgmap) for name, s in index.items()
-                }
-
-            counts = [cur_index[part][commit] for commit, date in history]
-            for count_dict in counts:
-                merge(count_dict, config.merge)
-
-            dates = [date for commit, date in history]
-
-            plot(
-                "loc-in-%s-by-%s.%s" % (part, by, args.format),
-                "Contributions (lines of code) over time in %s, by %s" % (part, by),
-                counts,
-                dates,
-                args.topn,
-            )
+    resolver = IdentityResolver(config.merge, config.orgmap, config.mailmap)
+    charts = []
+    with traced("phase", name="plot"):
+        for part in config.parts:
+            for by in ["author", "organization"]:
+                if by == "author":
+                    counts = CountMatrix.from_counts(
+                        [index[part][commit] for commit, date in history]
+                    ).resolve(resolver)
+                else:
+                    if not config.orgmap:
+                        print("==> No orgmap specified. Skipping.")
+                        continue
+                    org_stats = OrgStats(index[part], resolver)
+                    counts = CountMatrix.from_counts(
+                        [org_stats[commit] for commit, date in history]
+                    )
+                    org_stats.save()
+
+                dates = [date for commit, date in history]
+
+                charts.append(
+                    (
+                        "loc-in-%s-by-%s.%s" % (part, by, args.format),
+                        "Contributions (lines of code) over time in %s, by %s"
+                        % (part, by),
+                        counts,
+                        dates,
+                        args.topn,
+                    )
+                )
+
+        render_plots(charts, blame_jobs)
@@ -0,0 +1,65 @@
+# Copyright 2013-2019 Lawrence Livermore National Security, LLC and other
+# Spack Project Developers. See the top-level COPYRIGHT file for details.
+#
+# SPDX-License-Identifier: (Apache-2.0 OR MIT)
+
+import contrib.bench as bench
+import contrib.main as main
+
+
+def test_generate_repo(tmpdir, monkeypatch):
+    repo = str(tmpdir.join("repo"))
+    bench.generate_repo(repo, authors=3, files=10, commits=8, lines=5)
+
+    monkeypatch.setattr(main, "git_repo_dir", repo)
+    log = main.git("log", "--format=%H %aN")
+    assert len(log) == 8
+    assert set(line.split(" ", 1)[1] for line in log) <= set(
+        ["Author 0", "Author 1", "Author 2"]
+    )
+    assert len(main.git("ls-tree", "-r", "HEAD~7")) == 10
+
+    # the same arguments make the same history
+    other = str(tmpdir.join("other"))
+    bench.generate_repo(other, authors=3, files=10, commits=8, lines=5)
+    monkeypatch.setattr(main, "git_repo_dir", other)
+    assert main.git("log", "--format=%H %aN") == log
+
+
+def test_benchmark(tmpdir):
+    repo = str(tmpdir.join("repo"))
+    bench.generate_repo(repo, files=5, commits=5, lines=5)
+
+    results = bench.Benchmark(repo, str(tmpdir), samples=3, repeat=1, jobs=2).run()
+    assert sorted(results) == [
+        "OrgStats",
+        "build_index",
+        "count_matrix",
+        "files_for_commit",
+        "fuzz_history",
+        "git_blame",
+        "iter_blame",
+        "plot",
+        "sampled_history",
+        "startup_help",
+        "startup_index",
+    ]
+    assert all(sorted(times) == ["cold", "warm"] for times in results.values())
+    assert main.blame_pool is None
+    assert main.executor == "process"
+
+
+def test_compare():
+    baseline = {"git_blame": {"cold": 1.0, "warm": 0.1}, "plot": {"cold": 0.5}}
+    results = {
+        "git_blame": {"cold": 1.5, "warm": 0.101},
+        "plot": {"cold": 0.5, "warm": 0.4},
+    }
+
+    rows, regressions = bench.compare(results, baseline, threshold=0.1)
+    assert [(name, state) for name, state, _, _, _ in rows] == [
+        ("git_blame", "cold"),
+        ("git_blame", "warm"),
+        ("plot", "cold"),
+    ]
+    assert regressions == [("git_blame", "cold", 1.0, 1.5, 1.5)]
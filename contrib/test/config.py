@@ -25,6 +25,7 @@ def test_read_config(config_dir):
     assert config.orgmap_file == os.path.normpath(
         os.path.join(config_dir, "author-to-org.json")
     )
+    assert config.mailmap == {"author1": "Author 1", "A. Two": "Author 2"}
     assert config.parts == {
         "packages": ["^pkg_regex_1$", "^pkg_regex_2$", "^pkg_regex_3$"],
         "core": ["^core_regex_1$", "^core_regex_2$", "^core_regex_3$"],
@@ -40,4 +41,5 @@ def test_read_config_no_parts(config_dir):
     assert config.repo == os.path.normpath(os.path.join(config_dir, "./spack"))
 
     assert not config.orgmap
+    assert not config.mailmap
     assert config.parts == {"all": [r"^.*$"]}
@@ -4,6 +4,7 @@
 # SPDX-License-Identifier: (Apache-2.0 OR MIT)
 
 import os
+import subprocess
 
 import py
 import pytest
@@ -32,3 +33,104 @@ def repo_dir():
     main.git_repo_dir = os.getcwd()
     yield
     main.git_repo_dir = old_repo_dir
+
+
+def git_commit(repo, author, files, date):
+    """Write ``files`` (a path-to-content dict) into ``repo`` and commit
+    them as ``author`` on ``date``.  Files with ``None`` content are
+    removed."""
+    for path, content in files.items():
+        path = repo.join(path)
+        if content is None:
+            path.remove()
+            continue
+        path.dirpath().ensure(dir=True)
+        path.write(content)
+
+    env = dict(os.environ)
+    env.update(
+        {
+            "GIT_AUTHOR_NAME": author,
+            "GIT_AUTHOR_EMAIL": "%s@example.com" % author.lower().replace(" ", "."),
+            "GIT_AUTHOR_DATE": date,
+            "GIT_COMMITTER_NAME": author,
+            "GIT_COMMITTER_EMAIL": "%s@example.com" % author.lower().replace(" ", "."),
+            "GIT_COMMITTER_DATE": date,
+        }
+    )
+    with repo.as_cwd():
+        subprocess.check_call(["git", "add", "-A"], env=env)
+        subprocess.check_call(["git", "commit", "-q", "-m", "update"], env=env)
+
+
+@pytest.fixture
+def git_repo(tmpdir):
+    """A small git repository with a few commits by two authors.
+
+    Also points ``contrib.main`` at the repository, and keeps its history
+    cache out of the current directory.
+    """
+    repo = tmpdir.join("repo")
+    repo.ensure(dir=True)
+    with repo.as_cwd():
+        subprocess.check_call(["git", "init", "-q"])
+
+    git_commit(
+        repo,
+        "Author One",
+        {
+            "lib/a.py": "# comment\n\nx = 1\ny = 2\nz = 3\n",
+            "lib/b.py": "b = 1\nc = 2\n",
+            "docs/readme.txt": "hello\nworld\n",
+        },
+        "2019-01-01T12:00:00+00:00",
+    )
+    git_commit(
+        repo,
+        "Author Two",
+        {"lib/a.py": "# comment\n\nx = 1\ny = 2\nz = 3\nw = 4\nv = 5\n"},
+        "2019-02-01T12:00:00+00:00",
+    )
+    git_commit(
+        repo,
+        "Author One",
+        {"lib/c.py": "c = 1\n"},
+        "2019-03-01T12:00:00+00:00",
+    )
+    git_commit(
+        repo,
+        "Author Two",
+        {"lib/b.py": "b = 1\nc = 3\n"},
+        "2019-04-01T12:00:00+00:00",
+    )
+
+    old_repo_dir, old_history_file = main.git_repo_dir, main.history_file
+    main.git_repo_dir = str(repo)
+    main.history_file = str(tmpdir.join("history.json"))
+    yield repo
+    main.git_repo_dir, main.history_file = old_repo_dir, old_history_file
+
+
+@pytest.fixture
+def add_commit(git_repo):
+    """Function to add more commits to ``git_repo``."""
+
+    def add(author, files, date):
+        git_commit(git_repo, author, files, date)
+
+    return add
+
+
+class SerialPool(object):
+    """Stand-in for ``multiprocessing.Pool`` that runs tasks in-process."""
+
+    def imap_unordered(self, func, iterable):
+        return map(func, iterable)
+
+
+@pytest.fixture
+def serial_pool():
+    old_pool = main.blame_pool
+    main.blame_pool = SerialPool()
+    yield main.blame_pool
+    main.blame_pool = old_pool
@@ -3,9 +3,16 @@
 #
 # SPDX-License-Identifier: (Apache-2.0 OR MIT)
 
+import argparse
 import collections
+import datetime
+import json
+import multiprocessing
 import os
 import re
+import subprocess
+import sys
+import time
 
 import pytest
 
@@ -19,6 +26,18 @@ def test_die(capsys):
     assert "foobar" in output.err
 
 
+def test_no_matplotlib_on_import():
+    # non-plotting commands and blame workers should not load matplotlib
+    # or numpy
+    script = (
+        "import sys, contrib.main; "
+        "print('matplotlib' in sys.modules, 'numpy' in sys.modules)"
+    )
+    root = os.path.dirname(os.path.dirname(main.__file__))
+    output = subprocess.check_output([sys.executable, "-c", script], cwd=root)
+    assert output.strip() == b"False False"
+
+
 def test_working_dir(tmpdir):
     start_dir = os.getcwd()
     with main.working_dir(str(tmpdir)) as directory:
@@ -100,3 +119,949 @@ def test_iter_blame(tmpdir, repo_dir):
         counts[name] += 1
 
     assert counts == {"Todd Gamblin": 339, "Adam J. Stewart": 1}
+
+
+def test_count_blame(tmpdir, git_repo):
+    head = main.git("rev-parse", "HEAD", split=False).strip()
+    with tmpdir.as_cwd():
+        output = main.git_blame_file((head, "lib/a.py", "cache/a.txt"))
+
+    # comments and blank lines are ignored
+    assert main.count_blame(output) == {"Author One": 3, "Author Two": 2}
+
+
+def test_index_blames_unchanged_files_once(tmpdir, git_repo, serial_pool, monkeypatch):
+    history = list(main.linear_history())
+    places = [re.compile(r"^lib/")]
+
+    with tmpdir.as_cwd():
+        full = {c: main.git_blame(c, places, "lib") for c, _ in history}
+
+        monkeypatch.setattr(main, "parts_dir", "index-parts")
+        monkeypatch.setattr(main, "blame_store_path", "index-blame.sqlite")
+        index = main._build_index(history, {"lib": [r"^lib/"]})
+
+        for commit, _ in history:
+            assert index["lib"][commit] == full[commit]
+
+        # every file is blamed at HEAD, after that only changed files are
+        assert main.count_cache_stats == {"hits": 0, "misses": 3 + 1 + 0 + 1}
+
+
+@pytest.mark.parametrize("executor", ["process", "thread", "asyncio"])
+def test_index_window(tmpdir, git_repo, add_commit, serial_pool, monkeypatch, executor):
+    add_commit("Author Three", {"lib/d.py": "d = 1\n"}, "2019-05-01T12:00:00+00:00")
+    history = list(main.linear_history())
+    places = [re.compile(r"^lib/")]
+
+    with tmpdir.as_cwd():
+        full = {c: main.git_blame(c, places, "lib") for c, _ in history}
+
+        # one commit planned at a time, and no counts reused in memory
+        monkeypatch.setattr(main, "blame_pool", None)
+        monkeypatch.setattr(main, "executor", executor)
+        monkeypatch.setattr(main, "index_window", 1)
+        monkeypatch.setattr(main, "index_recent_files", 1)
+        monkeypatch.setattr(main, "parts_dir", "window-parts")
+        index = main.build_index(history, {"lib": [r"^lib/"]})
+
+        for commit, _ in history:
+            assert index["lib"][commit] == full[commit]
+
+
+def test_changed_files(git_repo):
+    history = [c for c, _ in main.linear_history()]
+    blob = main.git_objects().read(history[0] + ":lib/b.py")[0]
+    assert main.changed_files(history[1], history[0]) == {"lib/b.py": blob}
+
+    # going back in time, lib/c.py is deleted
+    changes = main.changed_files(history[1], history[3])
+    assert sorted(changes) == ["lib/a.py", "lib/c.py"]
+    assert changes["lib/c.py"] is None
+
+    assert main.changed_files(history[3], history[0], ["docs/"]) == {}
+
+
+def test_incremental_index(tmpdir, git_repo, add_commit, serial_pool, monkeypatch):
+    add_commit("Author Three", {"lib/a.py": None}, "2019-05-01T12:00:00+00:00")
+    history = list(main.linear_history())
+    places = [re.compile(r"^lib/")]
+
+    with tmpdir.as_cwd():
+        full = {c: main.git_blame(c, places, "lib") for c, _ in history}
+
+        listed = []
+        ls_tree = main.ls_tree
+        monkeypatch.setattr(
+            main, "ls_tree", lambda c, p=None: listed.append(c) or ls_tree(c, p)
+        )
+        monkeypatch.setattr(main, "incremental", True)
+        monkeypatch.setattr(main, "parts_dir", "incremental-parts")
+        index = main._build_index(history, {"lib": [r"^lib/"]})
+
+        for commit, _ in history:
+            assert index["lib"][commit] == full[commit]
+
+        # only the first planned commit's tree is listed
+        assert listed == [history[0][0]]
+
+
+def test_index_blames_each_file_once(tmpdir, git_repo, serial_pool):
+    head = main.git_objects().rev_parse("HEAD")
+    parts = {
+        "all": [r".*"],
+        "lib": [r"^lib/", r"\.py$"],
+        "docs": [r"^docs/"],
+    }
+
+    with tmpdir.as_cwd():
+        main.count_cache_stats.clear()
+        index = main._build_index([(head, None)], parts)
+        assert main.count_cache_stats == {"hits": 0, "misses": 4}
+
+        assert index["all"][head] == {"Author One": 7, "Author Two": 3}
+        assert index["lib"][head] == {"Author One": 5, "Author Two": 3}
+        assert index["docs"][head] == {"Author One": 2}
+
+
+def test_files_for_commit_dedup(git_repo):
+    files = main.files_for_commit("HEAD", [re.compile(r"^lib/"), re.compile(r"a\.py$")])
+    assert files == ["lib/a.py", "lib/b.py", "lib/c.py"]
+
+
+def test_ls_tree(git_repo):
+    tree = dict(main.ls_tree("HEAD"))
+    assert sorted(tree) == ["docs/readme.txt", "lib/a.py", "lib/b.py", "lib/c.py"]
+    assert tree["lib/a.py"] == main.git("rev-parse", "HEAD:lib/a.py")[0]
+
+
+def test_ls_tree_prefixes(git_repo, monkeypatch):
+    objects = main.git_objects()
+    assert main.ls_tree("HEAD", ["lib/"]) == [
+        (path, blob) for path, blob in main.ls_tree("HEAD") if path.startswith("lib/")
+    ]
+    assert main.ls_tree("HEAD", ["docs/readme"]) == []
+
+    # unchanged subtrees are not read again for another commit
+    reads = []
+    read = objects.read
+    monkeypatch.setattr(objects, "read", lambda rev: reads.append(rev) or read(rev))
+    main.ls_tree("HEAD~1")
+    assert reads == ["HEAD~1^{tree}", main.git("rev-parse", "HEAD~1:lib")[0]]
+
+
+def test_tree_cache_size(git_repo, monkeypatch):
+    monkeypatch.setattr(main, "git_tree_cache_size", 2)
+    objects = main.GitObjects(main.git_repo_dir)
+    try:
+        for commit, _ in main.linear_history():
+            objects.ls_tree(commit)
+            assert len(objects.trees) <= 2
+        assert objects.ls_tree("HEAD") == main.ls_tree("HEAD")
+    finally:
+        objects.close()
+
+
+def test_literal_prefix():
+    def prefix(pattern, flags=0):
+        return main.literal_prefix(re.compile(pattern, flags))
+
+    assert prefix(r"^lib/") == "lib/"
+    assert prefix(r"^var/spack/repos/builtin/packages/") == (
+        "var/spack/repos/builtin/packages/"
+    )
+    assert prefix(r"^lib/spack/.*\.py$") == "lib/spack/"
+    assert prefix(r"^lib\/spack/docs") == "lib/spack/"
+    assert prefix(r"^lib/spack/do?/") == "lib/spack/"
+    assert prefix(r"^lib/spack?/") == "lib/"
+    assert prefix(r"^lib/spack+/") == "lib/"
+    assert prefix(r"^lib/[a-z]+/") == "lib/"
+    assert prefix(r"^setup\.py$") == ""
+    assert prefix(r"lib/") == ""
+    assert prefix(r"^lib/|^var/") == ""
+    assert prefix(r"^lib/", re.IGNORECASE) == ""
+
+    places = [re.compile(p) for p in (r"^lib/", r"^lib/spack/", r"^var/x")]
+    assert main.place_prefixes(places) == ["lib/", "var/"]
+    assert main.place_prefixes(places + [re.compile(r"\.py$")]) is None
+
+
+def test_count_cache(tmpdir, git_repo, serial_pool):
+    history = [c for c, _ in main.linear_history()]
+    places = [re.compile(r"^lib/")]
+
+    with tmpdir.as_cwd():
+        main.count_cache_stats.clear()
+        main.git_blame(history[1], places, "lib")
+        assert main.count_cache_stats == {"hits": 0, "misses": 3}
+
+        # only lib/b.py differs at HEAD
+        main.count_cache_stats.clear()
+        main.git_blame(history[0], places, "lib")
+        assert main.count_cache_stats == {"hits": 2, "misses": 1}
+
+        blob = main.git("rev-parse", "HEAD:lib/a.py")[0]
+        assert main.blame_store().has_counts("lib/a.py", blob)
+
+        # raw blame output is only kept on request
+        assert main.blame_store().stats()["blame"]["entries"] == 0
+
+
+def test_git_blame_counts(tmpdir, git_repo):
+    head = main.git("rev-parse", "HEAD", split=False).strip()
+    with tmpdir.as_cwd():
+        output = main.git_blame_file((head, "lib/a.py", None))
+        expected = main.count_blame(output)
+
+        assert main.git_blame_counts(head, "lib/a.py") == expected
+
+        # raw output is compressed into the blame store while streaming
+        assert main.git_blame_counts(head, "lib/a.py", keep=True) == expected
+        assert main.blame_store().get_blame("lib/a.py", head) == output
+        assert main.git_blame_counts(head, "lib/a.py", keep=True) == expected
+
+
+def test_git_stream_error(git_repo):
+    with pytest.raises(subprocess.CalledProcessError):
+        with main.git_stream("blame", "HEAD", "--", "no/such/file") as lines:
+            list(lines)
+
+
+def test_git_objects(git_repo, add_commit):
+    objects = main.git_objects()
+    history = list(main.linear_history())
+
+    head = objects.rev_parse("HEAD")
+    assert head == history[0][0]
+    assert objects.rev_parse("HEAD~1") == history[1][0]
+    for commit, date in history:
+        assert objects.commit_date(commit) == date
+
+    assert sorted(objects.ls_tree(head)) == sorted(
+        (path, main.git("rev-parse", "HEAD:" + path)[0])
+        for path in main.git("ls-tree", "-r", "--name-only", "HEAD")
+    )
+
+    with pytest.raises(ValueError):
+        objects.rev_parse("no-such-branch")
+
+    # a forked child gets its own cat-file process
+    objects.pid = -1
+    assert objects.rev_parse("HEAD~2") == history[2][0]
+    assert objects.pid == os.getpid()
+
+    # only full sha1s are memoized, so HEAD is followed when it moves
+    assert objects.rev_parse(head) == head
+    assert head in objects.shas and "HEAD" not in objects.shas
+    add_commit("Author Three", {"lib/d.py": "d = 1\n"}, "2019-05-01T12:00:00+00:00")
+    assert objects.rev_parse("HEAD") == main.git("rev-parse", "HEAD")[0] != head
+
+
+def test_format_duration():
+    assert main.format_duration(12.4) == "12s"
+    assert main.format_duration(185) == "3m05s"
+    assert main.format_duration(3720) == "1h02m"
+
+
+def test_blame_progress(monkeypatch):
+    progress = main.BlameProgress("blame")
+    progress.commits = 4
+
+    # the first commit blames most files; later ones only a few
+    progress.add(3, 90.0)
+    progress.add(1, 10.0)
+    progress.add(1, 20.0)
+    now = time.time()
+    progress.start = now - 60
+    monkeypatch.setattr(time, "time", lambda: now)
+
+    # 60s for 90 of 120 planned, plus 15 for the commit not planned yet
+    monkeypatch.setattr(main, "verbose", True)
+    progress.update(False, 90.0)
+    assert "~30s left" in progress.line
+
+    # finished commits don't matter, only cost left
+    progress.commits_done = 1
+    progress.update(False, 10.0)
+    assert "~21s left" in progress.line
+
+
+def test_schedule_blames(tmpdir, git_repo, serial_pool):
+    head = main.git_objects().rev_parse("HEAD")
+    tree = dict(main.ls_tree(head))
+    tasks = [(head, f, tree[f]) for f in sorted(tree)]
+
+    with tmpdir.as_cwd():
+        costs = main.BlameCosts("costs.json")
+        ordered, estimates, sizes = main.schedule_blames(tasks, costs)
+        assert sizes[tree["lib/a.py"]] == len(
+            "# comment\n\nx = 1\ny = 2\nz = 3\nw = 4\nv = 5\n"
+        )
+
+        # largest files first
+        assert [f for _, f, _ in ordered] == [
+            "lib/a.py",
+            "docs/readme.txt",
+            "lib/b.py",
+            "lib/c.py",
+        ]
+
+        # recorded costs override size estimates
+        costs.record("lib/a.py", 36, 1.0)
+        costs.record("lib/c.py", 6, 100.0)
+        costs.save()
+        costs = main.BlameCosts("costs.json")
+        ordered, estimates, sizes = main.schedule_blames(tasks, costs)
+        assert ordered[0][1] == "lib/c.py"
+        assert estimates["lib/c.py", tree["lib/c.py"]] == 100.0
+
+        # cached files cost nothing
+        main.git_blame(head, [re.compile(r"^lib/c\.py$")], "c")
+        ordered, estimates, sizes = main.schedule_blames(tasks, costs)
+        assert ordered[-1][1] == "lib/c.py"
+        assert estimates["lib/c.py", tree["lib/c.py"]] == 0.0
+
+
+def test_replay_matches_blame(tmpdir, git_repo, add_commit, serial_pool, monkeypatch):
+    # rename with an edit, a deletion, and changes in several hunks
+    add_commit(
+        "Author Three",
+        {
+            "lib/b.py": None,
+            "lib/d.py": "b = 1\nc = 3\nd = 4\n",
+            "docs/readme.txt": None,
+        },
+        "2019-05-01T12:00:00+00:00",
+    )
+    add_commit(
+        "Author One",
+        {"lib/a.py": "# comment\n\nx = 0\ny = 2\nz = 3\nw = 4\n  v = 5\nu = 6\n"},
+        "2019-06-01T12:00:00+00:00",
+    )
+
+    history = list(main.linear_history())
+    parts = {"all": [r".*"], "lib": [r"^lib/"]}
+
+    with tmpdir.as_cwd():
+        blamed = main._build_index(history, parts)
+
+        monkeypatch.setattr(main, "parts_dir", "replay-parts")
+        replayed = main.replay_index(history, parts)
+
+        for commit, _ in history:
+            for part in parts:
+                assert replayed[part][commit] == blamed[part][commit]
+
+        assert replayed["lib"][history[0][0]] == {
+            "Author One": 6,
+            "Author Two": 3,
+            "Author Three": 1,
+        }
+
+
+def test_unquote_path():
+    assert main.unquote_path("a/foo bar") == "a/foo bar"
+    assert main.unquote_path('"a/tab\\there"') == "a/tab\there"
+    assert main.unquote_path('"a/caf\\303\\251"') == "a/café"
+
+
+def test_blame_store_gc(tmpdir):
+    with tmpdir.as_cwd():
+        store = main.blame_store()
+        for i in range(4):
+            blob = "%040x" % i
+            store.put_counts("lib/a.py", blob, {"Author %d" % i: i})
+
+        db = store._db()
+        db.execute("UPDATE counts SET used = used - 2 * ?", (store.used_resolution,))
+        statements = []
+        db.set_trace_callback(statements.append)
+
+        # reading an entry makes it recently used, but only writes if the
+        # last use was long enough ago
+        assert store.get_counts("lib/a.py", "%040x" % 0) == {"Author 0": 0}
+        assert store.get_counts("lib/a.py", "%040x" % 0) == {"Author 0": 0}
+        assert len([s for s in statements if s.startswith("UPDATE")]) == 1
+
+        # nothing to evict, so the database is left alone
+        size = store.stats()["counts"]["packed"]
+        assert store.gc(size) == (0, 0)
+        assert not any(s.startswith("VACUUM") for s in statements)
+
+        evicted, freed = store.gc(size // 2)
+        assert evicted == 2
+        assert store.has_counts("lib/a.py", "%040x" % 0)
+        assert not store.has_counts("lib/a.py", "%040x" % 1)
+        assert store.stats()["counts"]["packed"] == size - freed
+
+
+def test_blame_store_pack(tmpdir):
+    commit = "c" * 40
+    tmpdir.join("old/counts/lib/a.py/%s.json" % ("b" * 40)).ensure().write(
+        json.dumps({"Author One": 2})
+    )
+    tmpdir.join("old/blame/lib/a.py/%s.txt" % commit).ensure().write("output\n")
+
+    with tmpdir.as_cwd():
+        store = main.blame_store()
+        assert store.pack("old/counts", "old/blame") == 2
+        assert store.get_counts("lib/a.py", "b" * 40) == {"Author One": 2}
+        assert store.get_blame("lib/a.py", commit) == "output\n"
+        assert not os.path.exists("old/counts")
+        assert not os.path.exists("old/blame")
+
+
+def test_blame_store_packs_on_open(tmpdir, monkeypatch, capsys):
+    tmpdir.join("line-data/counts/lib/a.py/%s.json" % ("b" * 40)).ensure().write(
+        json.dumps({"Author One": 2})
+    )
+
+    with tmpdir.as_cwd():
+        monkeypatch.setattr(main, "_blame_store", None)
+        assert main.blame_store().get_counts("lib/a.py", "b" * 40) == {"Author One": 2}
+        assert not os.path.exists("line-data/counts")
+        assert "Packed 1 loose cache files" in capsys.readouterr().out
+
+
+def test_size_type():
+    assert main.size_type("100") == 100
+    assert main.size_type("2k") == 2048
+    assert main.size_type("1.5G") == 3 << 29
+    assert main.size_type("500MB") == 500 << 20
+    with pytest.raises(argparse.ArgumentTypeError):
+        main.size_type("lots")
+
+
+def test_fuzz_history(tmpdir, capsys):
+    def date(day):
+        return datetime.datetime(2019, 1, day, tzinfo=datetime.timezone.utc)
+
+    with tmpdir.as_cwd():
+        history = [("s1", date(1)), ("s2", date(5)), ("s3", date(19))]
+
+        # nothing cached yet
+        assert main.fuzz_history(history, 10, ["lib"]) == history
+
+        manifest = main.cache_manifest()
+        for commit, day in (("c1", 2), ("c2", 11), ("c3", 20)):
+            manifest.add("lib", commit, date(day), 1, 1)
+        manifest.add("docs", "c1", date(2), 1, 1)
+        manifest.add("docs", "c3", date(20), 1, 1)
+
+        # cached commits are 9 days apart, so 20% fuzz allows 1.8 days; the
+        # first cached commit is a valid match
+        assert main.fuzz_history(history, 20, ["lib"]) == [
+            ("c1", date(2)),
+            ("s2", date(5)),
+            ("c3", date(20)),
+        ]
+        output = capsys.readouterr().out
+        assert "replaced 2 of 3 samples with nearby cached commits.\n" in output
+
+        # substitutes must be cached for every part; c1 and c3 are now 18
+        # days apart, so 10% fuzz allows 1.8 days
+        history.append(("c2", date(11)))
+        assert main.fuzz_history(history, 10, ["lib", "docs"]) == [
+            ("c1", date(2)),
+            ("s2", date(5)),
+            ("c3", date(20)),
+            ("c2", date(11)),
+        ]
+
+
+def test_parse_date():
+    utc = datetime.timezone.utc
+    expected = datetime.datetime(2019, 1, 1, 12, tzinfo=utc)
+    assert main.parse_date("2019-01-01T12:00:00+00:00") == expected
+    assert main.parse_date("2019-01-01T12:00:00Z") == expected
+    assert main.parse_date("2019-01-01T14:00:00+02:00") == expected
+
+
+def test_parse_date_without_fromisoformat(monkeypatch):
+    # Python 3.6 has no datetime.fromisoformat()
+    monkeypatch.setattr(main, "_fromisoformat", None)
+    expected = datetime.datetime(2019, 1, 1, 12, tzinfo=datetime.timezone.utc)
+    assert main.parse_date("2019-01-01T12:00:00+00:00") == expected
+    assert main.parse_date("2019-01-01T12:00:00Z") == expected
+
+
+def test_commit_history(git_repo, add_commit, monkeypatch):
+    log = main.git("log", "--first-parent", "--no-merges", "--format=%H %cI")
+    expected = [(line.split()[0], main.parse_date(line.split()[1])) for line in log]
+    assert main.commit_history() == expected
+
+    with open(main.history_file) as f:
+        assert json.load(f)["head"] == expected[0][0]
+
+    # only new commits are walked when HEAD moves forward
+    add_commit("Author One", {"lib/d.py": "d = 1\n"}, "2019-05-01T12:00:00+00:00")
+    walked = []
+    walk = main._walk_history
+    monkeypatch.setattr(
+        main, "_walk_history", lambda rev: walked.append(rev) or walk(rev)
+    )
+    history = main.commit_history()
+    assert history[1:] == expected
+    assert walked == ["%s..%s" % (expected[0][0], history[0][0])]
+
+    # a rewritten branch is walked again from scratch
+    with open(main.history_file) as f:
+        cached = json.load(f)
+    cached["head"] = "0" * 40
+    with open(main.history_file, "w") as f:
+        json.dump(cached, f)
+    main._history = None
+    del walked[:]
+    assert main.commit_history() == history
+    assert walked == [history[0][0]]
+
+
+def test_churn_sampled_history(git_repo, add_commit):
+    places = [re.compile(r"^lib/")]
+    add_commit("Author One", {"lib/d.py": "d = 1\n" * 20}, "2019-05-01T12:00:00+00:00")
+    add_commit("Author Two", {"docs/readme.txt": "hi\n"}, "2019-06-01T12:00:00+00:00")
+    add_commit("Author Two", {"lib/c.py": "c = 2\n"}, "2019-07-01T12:00:00+00:00")
+
+    churn = [lines for _, lines in main.commit_churn(places)]
+    assert churn == [2, 20, 2, 1, 2, 7]
+
+    # 33 lines changed in lib, so there is a sample about every 11 lines
+    history = main.commit_history()
+    assert main.churn_sampled_history(4, places) == [history[i] for i in (0, 2, 3, 6)]
+
+    # with budget for every commit, all are sampled
+    assert main.churn_sampled_history(10, places) == history
+
+    # one sample is just the latest commit
+    assert main.churn_sampled_history(1, places) == history[:1]
+
+
+def test_update_org_map(tmpdir, git_repo, add_commit, monkeypatch, capsys):
+    monkeypatch.setattr(main, "org_map_scan_file", str(tmpdir.join("scan.json")))
+    filename = str(tmpdir.join("orgmap.json"))
+
+    ranges = []
+    git_stream = main.git_stream
+
+    def recording_git_stream(*args):
+        ranges.append(args[-1])
+        return git_stream(*args)
+
+    monkeypatch.setattr(main, "git_stream", recording_git_stream)
+
+    def read_orgmap():
+        with open(filename) as f:
+            return json.load(f)
+
+    assert main.update_org_map(filename, {}) == ["Author One", "Author Two"]
+    assert read_orgmap() == {
+        "Author One": "unknown <author.one@example.com>",
+        "Author Two": "unknown <author.two@example.com>",
+    }
+    assert "Author Two <author.two@example.com>" in capsys.readouterr().out
+
+    # only new commits are scanned, and the file is only rewritten on change
+    head = main.git("rev-parse", "HEAD")[0]
+    add_commit("Author Three", {"lib/three.py": "3\n"}, "2019-02-01T00:00:00")
+    assert main.update_org_map(filename, read_orgmap()) == ["Author Three"]
+    assert ranges[-1].startswith(head + "..")
+
+    mtime = os.stat(filename).st_mtime_ns
+    assert main.update_org_map(filename, read_orgmap()) == []
+    assert os.stat(filename).st_mtime_ns == mtime
+    assert "No new authors" in capsys.readouterr().out
+
+    # an edited orgmap is checked against the whole history again
+    orgmap = {"Author One": "Org", "Author Three": "Org"}
+    assert main.update_org_map(filename, orgmap) == ["Author Two"]
+    assert ".." not in ranges[-1]
+    assert read_orgmap()["Author One"] == "Org"
+
+
+def test_shard_history():
+    history = list(range(10))
+    shards = [main.shard_history(history, i, 3) for i in (1, 2, 3)]
+    assert shards == [[0, 3, 6, 9], [1, 4, 7], [2, 5, 8]]
+
+    assert main.shard_type("2/8") == (2, 8)
+    for bad in ("0/8", "9/8", "2", "a/b"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            main.shard_type(bad)
+
+
+def test_count_matrix():
+    counts = [{"a": 1, "b": 2}, {"b": 3, "c": 4}, {}]
+    matrix = main.CountMatrix.from_counts(counts)
+    assert matrix.names == ["a", "b", "c"]
+    assert matrix.matrix.tolist() == [[1, 0, 0], [2, 3, 0], [0, 4, 0]]
+    assert len(matrix) == 3
+
+    # later lists merge users merged by earlier ones
+    merged = matrix.resolve(main.IdentityResolver([["b", "a"], ["c", "b"]]))
+    assert merged.names == ["c"]
+    assert merged.matrix.tolist() == [[3, 7, 0]]
+
+    orgs = matrix.group(lambda name: "vowel" if name == "a" else "consonant")
+    assert orgs.names == ["vowel", "consonant"]
+    assert orgs.matrix.tolist() == [[1, 0, 0], [2, 7, 0]]
+
+
+def test_identity_resolver():
+    resolver = main.IdentityResolver(
+        merge_list=[["Author One", "one"]],
+        authors_to_orgs={"Author One": "Org", "Two": "unknown (Two)", "Three": "X"},
+        mailmap={"a. one": "one", "Three": "Author Three"},
+    )
+    assert resolver.identity("a. one") == "Author One"
+    assert resolver.identity("Three") == "Author Three"
+    assert resolver.identity("Four") == "Four"
+
+    # orgs are looked up by raw name, then by canonical name
+    assert resolver.org("a. one") == "Org"
+    assert resolver.org("Three") == "X"
+    assert resolver.org("Two") == "unknown"
+    assert resolver.org("Four") == "unknown"
+
+    stats = {"Author One": 1, "one": 2, "a. one": 3, "Two": 4, "Four": 5}
+    assert resolver.authors(stats) == {"Author One": 6, "Two": 4, "Four": 5}
+    assert resolver.organizations(stats) == {"Org": 6, "unknown": 9}
+
+    assert main.IdentityResolver().key != resolver.key
+    assert main.IdentityResolver().key == main.IdentityResolver().key
+
+
+def test_org_stats_cache(tmpdir, git_repo, serial_pool):
+    history = list(main.linear_history())
+    with tmpdir.as_cwd():
+        author_stats = main.AuthorStats("lib", [re.compile(r"^lib/")])
+        resolver = main.IdentityResolver([], {"Author One": "Org"})
+        org_stats = main.OrgStats(author_stats, resolver)
+        expected = [org_stats[commit] for commit, _ in history]
+        assert expected[0] == {"Org": 5, "unknown": 3}
+        org_stats.save()
+
+        # resolved stats are read back without loading the author stats
+        author_stats.commits.clear()
+        os.remove(author_stats._path(history[0][0]))
+        cached = main.OrgStats(author_stats, resolver)
+        assert [cached[commit] for commit, _ in history] == expected
+
+        # a different orgmap makes new stats
+        other = main.IdentityResolver([], {"Author Two": "Org"})
+        assert main.OrgStats(author_stats, other)[history[0][0]] == {
+            "Org": 3,
+            "unknown": 5,
+        }
+
+        # replaced author stats are resolved again
+        head = history[0][0]
+        author_stats.update(head, {"Author One": 2, "Author Two": 1}, files=3)
+        cached = main.OrgStats(author_stats, resolver)
+        assert cached[head] == {"Org": 2, "unknown": 1}
+
+        # incomplete stats are not cached
+        partial = main.AuthorStats("partial", [re.compile(r"^lib/")])
+        partial.update(head, {"Author One": 2}, skipped=["lib/b.py"])
+        org_stats = main.OrgStats(partial, resolver)
+        assert org_stats[head] == {"Org": 2}
+        assert head not in org_stats.cache
+
+
+def test_plot(tmpdir, monkeypatch):
+    plt = main.pyplot()
+    stacked = {}
+
+    def stackplot(x, series, labels, **kwargs):
+        stacked.update(series=series.tolist(), labels=labels)
+
+    monkeypatch.setattr(plt, "stackplot", stackplot)
+
+    dates = [datetime.datetime(2019, 1, d) for d in (3, 1, 2)]
+    counts = [
+        {"a": 5, "b": 1, "unknown": 9, "d": 2},
+        {"a": 1, "c": 8},
+        {"b": 2, "c": 3},
+    ]
+    filename = str(tmpdir.join("plot.png"))
+    main.plot(filename, "Plot", counts, dates, top_n=2)
+
+    assert os.path.exists(filename)
+    with open(filename + ".json") as f:
+        assert json.load(f) == [["unknown", 9], ["a", 5], ["d", 2], ["b", 1]]
+
+    # top 2 besides "unknown", which goes in "Other" with everyone else
+    assert stacked["labels"] == ["Other", "d", "a"]
+    assert stacked["series"] == [[8, 5, 10], [0, 0, 2], [1, 0, 5]]
+
+
+def test_render_plots(tmpdir, monkeypatch, capsys):
+    monkeypatch.setattr(main, "plots_file", str(tmpdir.join("plots.json")))
+    dates = [datetime.datetime(2019, 1, d) for d in (1, 2)]
+    counts = main.CountMatrix.from_counts([{"a": 1}, {"a": 2, "b": 1}])
+
+    methods = []
+    get_context = multiprocessing.get_context
+    monkeypatch.setattr(
+        multiprocessing,
+        "get_context",
+        lambda method=None: methods.append(method) or get_context(method),
+    )
+
+    with tmpdir.as_cwd():
+        charts = [
+            ("a.png", "A", counts, dates, 20),
+            ("b.png", "B", counts.resolve(main.IdentityResolver()), dates, 20),
+        ]
+        assert main.render_plots(charts, jobs=2) == 2
+        assert os.path.exists("a.png") and os.path.exists("b.png.json")
+        if "fork" in multiprocessing.get_all_start_methods():
+            assert methods[-1] == "fork"
+
+        # nothing changed
+        assert main.render_plots(charts, jobs=2) == 0
+        assert "Plot is up to date: a.png" in capsys.readouterr().out
+
+        # new data, a new format, or a missing file means a new plot
+        merged = counts.resolve(main.IdentityResolver([["b", "a"]]))
+        charts[0] = ("a.png", "A", merged, dates, 20)
+        assert main.render_plots(charts) == 1
+        charts[1] = ("b.svg", "B", charts[1][2], dates, 20)
+        assert main.render_plots(charts) == 1
+        os.remove("a.png")
+        assert main.render_plots(charts) == 1
+
+
+def test_merge_cache(tmpdir, capsys):
+    def write(path, stats):
+        tmpdir.join(path).ensure().write(json.dumps(stats))
+
+    sha_a, sha_b, sha_c = "a" * 40, "b" * 40, "c" * 40
+    write("shard1/parts/all/%s.json" % sha_a, {"Author One": 1})
+    write("shard1/parts/all/%s.json" % sha_b, {"Author Two": 2})
+    write("shard2/parts/all/%s.json" % sha_b, {"Author Two": 2})
+    write("shard2/parts/all/%s.json" % sha_c, {"Author One": 3})
+    record = {
+        "part": "all",
+        "commit": sha_a,
+        "date": "2019-01-01T00:00:00+00:00",
+        "files": 1,
+        "lines": 1,
+    }
+    write("shard1/parts/manifest.jsonl", record)
+
+    with tmpdir.as_cwd():
+        assert main.merge_cache(["shard1", "shard2/parts"]) == 3
+        with open("line-data/parts/all/%s.json" % sha_c) as f:
+            assert json.load(f) == {"Author One": 3}
+
+        # manifest records are carried over; fake SHAs aren't in git
+        assert main.cache_manifest().get("all", sha_a) == record
+        assert ("all", sha_c) not in main.cache_manifest()
+
+        # merging again is a no-op
+        assert main.merge_cache(["shard1", "shard2"]) == 0
+
+        # conflicting stats abort the whole merge
+        write("shard3/parts/all/%s.json" % sha_a, {"Author One": 2})
+        write("shard3/parts/other/%s.json" % sha_a, {"Author One": 2})
+        with pytest.raises(SystemExit):
+            main.merge_cache(["shard3"])
+        assert not os.path.exists("line-data/parts/other")
+        assert "conflicts with" in capsys.readouterr().err
+
+        # complete stats replace incomplete ones, and never the reverse
+        incomplete = {"Author One": 1, main.skipped_key: ["lib/a.py"]}
+        write("line-data/parts/all/%s.json" % sha_c, incomplete)
+        write("shard4/parts/all/%s.json" % sha_b, incomplete)
+        write("shard4/parts/all/%s.json" % sha_c, {"Author One": 4})
+        assert main.merge_cache(["shard4"]) == 1
+        with open("line-data/parts/all/%s.json" % sha_b) as f:
+            assert json.load(f) == {"Author Two": 2}
+        with open("line-data/parts/all/%s.json" % sha_c) as f:
+            assert json.load(f) == {"Author One": 4}
+
+        # a shard's working directory is not a cache
+        tmpdir.join("shard5/line-data/history.json").ensure()
+        with pytest.raises(SystemExit):
+            main.merge_cache(["shard5"])
+        assert "no cached commit stats in 'shard5'" in capsys.readouterr().err
+
+
+def test_cache_manifest(tmpdir, git_repo, monkeypatch):
+    history = list(main.linear_history())
+    head = history[0][0]
+
+    with tmpdir.as_cwd():
+        main.build_index(history, {"lib": [r"^lib/"]})
+        manifest = main.cache_manifest()
+        assert len(manifest.commits("lib")) == len(history)
+        record = manifest.get("lib", head)
+        assert record["files"] == 3
+        assert record["lines"] == 8
+
+        # a truncated record is ignored
+        with open(manifest.path, "a") as f:
+            f.write('{"part": "lib", "comm')
+        loaded = main.CacheManifest(manifest.path)
+        assert loaded.entries == manifest.entries
+
+        # the next record starts on a line of its own
+        loaded.add_record(dict(record, part="docs"))
+        reloaded = main.CacheManifest(manifest.path)
+        assert reloaded.get("docs", head) == dict(record, part="docs")
+        assert reloaded.get("lib", head) == record
+
+        # caches without a manifest are scanned once to build one
+        os.remove(manifest.path)
+        rebuilt = main.CacheManifest(manifest.path)
+        assert os.path.exists(manifest.path)
+        assert sorted(rebuilt.entries) == sorted(manifest.entries)
+        assert rebuilt.get("lib", head)["lines"] == 8
+
+        assert head in main.AuthorStats("lib", [r"^lib/"])
+
+        # stats written by a run killed before it updated the manifest
+        with open(manifest.path, "w") as f:
+            for key, entry in sorted(rebuilt.entries.items()):
+                if key != ("lib", head):
+                    f.write(json.dumps(entry) + "\n")
+        monkeypatch.setattr(main, "_cache_manifest", None)
+        assert ("lib", head) not in main.cache_manifest()
+        assert head in main.AuthorStats("lib", [r"^lib/"])
+        assert main.CacheManifest(manifest.path).get("lib", head)["lines"] == 8
+
+
+def test_thread_executor(tmpdir, git_repo, monkeypatch):
+    history = list(main.linear_history())
+    start_dir = os.getcwd()
+
+    with tmpdir.as_cwd():
+        monkeypatch.setattr(main, "executor", "thread")
+        monkeypatch.setattr(main, "blame_jobs", 4)
+        index = main.build_index(history, {"lib": [r"^lib/"]})
+        assert os.getcwd() == str(tmpdir)
+
+    assert os.getcwd() == start_dir
+    assert index["lib"][history[0][0]] == {"Author One": 5, "Author Two": 3}
+
+
+def test_trace(tmpdir, git_repo, monkeypatch):
+    history = list(main.linear_history())
+    trace_file = str(tmpdir.join("trace.jsonl"))
+
+    with tmpdir.as_cwd():
+        monkeypatch.setattr(main, "executor", "thread")
+        monkeypatch.setattr(main, "trace_file", trace_file)
+        monkeypatch.setattr(main, "_trace_fds", {})
+        with main.traced("phase", name="index"):
+            main.build_index(history, {"lib": [r"^lib/"]})
+        assert main.trace("done", runs=1) is None
+
+    with open(trace_file) as f:
+        events = [json.loads(line) for line in f]
+
+    kinds = set(e["event"] for e in events)
+    assert set(["git", "blame", "blame_cache", "git_objects", "phase"]) <= kinds
+
+    blames = [e for e in events if e["event"] == "blame"]
+    assert all(e["seconds"] >= 0 and not e["failed"] for e in blames)
+    assert all(e["queue_seconds"] >= 0 for e in blames)
+    assert any(not e["cached"] for e in blames)
+
+    cache = [e for e in events if e["event"] == "blame_cache"]
+    assert sum(e["misses"] for e in cache) == len(blames)
+
+    phase = [e for e in events if e["event"] == "phase"]
+    assert phase[0]["name"] == "index"
+    assert phase[0] == events[-2]
+    assert events[-1]["event"] == "done" and events[-1]["runs"] == 1
+
+
+def test_asyncio_executor(tmpdir, git_repo, monkeypatch):
+    history = list(main.linear_history())
+
+    with tmpdir.as_cwd():
+        monkeypatch.setattr(main, "executor", "asyncio")
+        monkeypatch.setattr(main, "keep_blame", True)
+        index = main.build_index(history, {"lib": [r"^lib/"]})
+        assert index["lib"][history[0][0]] == {"Author One": 5, "Author Two": 3}
+        assert main.blame_store().stats()["blame"]["entries"] == 3 + 1 + 1
+
+
+def test_asyncio_timeout(tmpdir, git_repo, monkeypatch):
+    head = main.git_objects().rev_parse("HEAD")
+
+    with tmpdir.as_cwd():
+        monkeypatch.setattr(main, "executor", "asyncio")
+        monkeypatch.setattr(main, "blame_timeout", 1e-9)
+        monkeypatch.setattr(main, "blame_retries", 1)
+        index = main.build_index([(head, None)], {"lib": [r"^lib/"]})
+
+        # failed files don't abort the build, and are reported in the JSON
+        assert index["lib"][head] == {}
+        assert sorted(f for f, _, _ in main.failed_blames) == [
+            "lib/a.py",
+            "lib/b.py",
+            "lib/c.py",
+        ]
+        with open(index["lib"]._path(head)) as f:
+            assert json.load(f) == {
+                main.skipped_key: ["lib/a.py", "lib/b.py", "lib/c.py"]
+            }
+
+        # the commit is not cached, so the next run blames the files again
+        assert (("lib", head)) not in main.cache_manifest()
+        main.cache_manifest()._rebuild()
+        assert ("lib", head) not in main.cache_manifest()
+
+        # the same goes for a commit blamed on its own
+        monkeypatch.setattr(main, "blame_pool", main.AsyncBlamePool(1))
+        direct = main.AuthorStats("direct", [re.compile(r"^lib/")])
+        assert direct[head] == {}
+        assert ("direct", head) not in main.cache_manifest()
+        monkeypatch.setattr(main, "blame_pool", None)
+
+        monkeypatch.setattr(main, "blame_timeout", None)
+        index = main.build_index([(head, None)], {"lib": [r"^lib/"]})
+        assert index["lib"][head] == {"Author One": 5, "Author Two": 3}
+        assert ("lib", head) in main.cache_manifest()
+
+
+def test_skipped_reasons(tmpdir, git_repo, monkeypatch, capsys):
+    head = main.git_objects().rev_parse("HEAD")
+
+    statuses = {"lib/a.py": 1, "lib/b.py": 2, "lib/c.py": 3}
+
+    async def fail(commit, filename, keep=False):
+        raise subprocess.CalledProcessError(statuses[filename], ["git", "blame"])
+
+    with tmpdir.as_cwd():
+        monkeypatch.setattr(main, "executor", "asyncio")
+        monkeypatch.setattr(main, "blame_retries", 0)
+        monkeypatch.setattr(main, "async_blame_counts", fail)
+        main.build_index([(head, None)], {"lib": [r"^lib/"], "a": [r"^lib/a"]})
+
+    # each file is reported with its own error
+    out = capsys.readouterr().out
+    for f, status in statuses.items():
+        assert "SKIPPED %s: git blame exited with status %d" % (f, status) in out
+
+
+def test_timeout_requires_asyncio(monkeypatch, capsys):
+    for option in ("--timeout", "--retries"):
+        argv = ["contrib", "--executor", "thread", option, "1"]
+        monkeypatch.setattr(sys, "argv", argv)
+        with pytest.raises(SystemExit):
+            main.main()
+        assert "%s requires --executor asyncio" % option in capsys.readouterr().err
+
+
+def test_profile_requires_file(capsys):
+    parser = main.create_parser()
+    args = parser.parse_args(["--profile", "out.prof", "cache", "stats"])
+    assert args.profile == "out.prof"
+    assert args.command == "cache"
+
+    with pytest.raises(SystemExit):
+        parser.parse_args(["--profile"])
+    assert "expected one argument" in capsys.readouterr().err
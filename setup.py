@@ -31,6 +31,7 @@ setuptools.setup(
         "python-dateutil",
         "jsonschema",
         "matplotlib",
+        "numpy",
         "pyyaml",
         "setuptools",
     ],